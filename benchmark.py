@@ -0,0 +1,410 @@
+"""
+Offline load test for the Music cog.
+
+Runs the real cog and player loops against stand-in Discord objects and a
+stand-in youtube_dl, so nothing touches Discord or YouTube. Every "download"
+is a copy of a short generated audio file, and the voice clients read their
+sources in real time (but don't encode or send anything).
+
+For each guild count it reports commands per second, time to first audio,
+the gap between tracks, memory per player and event loop lag.
+
+    python benchmark.py --guilds 10,50,100,200 --tracks 3 --extract-latency 0.3
+
+FFmpeg must be installed, as it is for the bot.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix='tweedle-bench-')
+
+# Settings are read when music is imported, so they have to be in place first
+os.environ.update({
+    'DOWNLOAD_DIR': os.path.join(WORK_DIR, 'downloads'),
+    'STATE_PATH': os.path.join(WORK_DIR, 'state.db'),
+    'QUEUE_MODE': 'download',
+    'CACHE_MAX_MB': '0',
+    'OPUS_CACHE': '0',
+    'TEE_DOWNLOADS': '0',
+    'QUERY_CACHE_PERSIST': '0',
+    'METRICS_PORT': '0',
+    'METRICS_LOG_INTERVAL': '0',
+    'SNAPSHOT_INTERVAL': '0',
+})
+os.makedirs(os.environ['DOWNLOAD_DIR'], exist_ok=True)
+
+import extractor  # noqa: E402
+import music  # noqa: E402
+
+FRAME_DURATION = 0.02
+
+
+def make_fixture(seconds):
+    """Generate the audio file every download is a copy of."""
+    path = os.path.join(WORK_DIR, 'fixture.wav')
+    subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={seconds}',
+                    '-ac', '2', '-ar', '48000', path], check=True)
+    return path
+
+
+class FakeExtractor:
+    """
+    Canned youtube_dl results, after a configurable (jittered) delay.
+
+    Searches map onto a catalog of ``catalog`` tracks, so a small catalog
+    makes for more cache hits. The functions run on the real extractor pool.
+    """
+
+    def __init__(self, fixture, duration, *, catalog, extract_latency, download_latency,
+                 jitter=0.25):
+        self.fixture = fixture
+        self.duration = duration
+        self.catalog = catalog
+        self.extract_latency = extract_latency
+        self.download_latency = download_latency
+        self.jitter = jitter
+
+    def delay(self, seconds):
+        time.sleep(max(0.0, random.gauss(seconds, seconds * self.jitter)))
+
+    def data(self, query):
+        number = int(hashlib.md5(query.encode()).hexdigest(), 16) % self.catalog
+        video_id = f'bench{number:07d}'
+        url = f'https://www.youtube.com/watch?v={video_id}'
+        return {
+            'id': video_id, 'extractor': 'youtube', 'title': f'Benchmark track {number}',
+            'alt_title': None, 'uploader': 'benchmark', 'creator': None,
+            'duration': self.duration, 'thumbnail': None, 'ext': 'wav',
+            'webpage_url': url, 'url': self.fixture, 'protocol': 'file'
+        }
+
+    def install(self):
+        """Swap the extractor's job functions for these ones."""
+        def info(url):
+            self.delay(self.extract_latency)
+            return self.data(url)
+
+        def download(url):
+            data = info(url)
+            self.delay(self.download_latency)
+            path = os.path.join(os.environ['DOWNLOAD_DIR'], f"youtube-{data['id']}.wav")
+            if not os.path.exists(path):
+                shutil.copyfile(self.fixture, path)
+            return path, data
+
+        def locate(url):
+            data = info(url)
+            return os.path.join(os.environ['DOWNLOAD_DIR'], f"youtube-{data['id']}.wav"), data
+
+        extractor.info = info
+        extractor.download = download
+        extractor.locate = locate
+
+
+class FakeMessage:
+    embeds = []
+
+    async def delete(self):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild, members=()):
+        self.id = channel_id
+        self.guild = guild
+        self.members = list(members)
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage()
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+
+class FakeUser:
+    def __init__(self, user_id, name, *, bot=False, voice=None):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+        self.voice = voice
+        self.mention = f'<@{user_id}>'
+
+    def __str__(self):
+        return self.name
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.text_channel = FakeChannel(guild_id * 10 + 1, self)
+        self.voice_channel = FakeChannel(guild_id * 10 + 2, self)
+        self.member = FakeUser(guild_id * 10 + 3, f'listener-{guild_id}',
+                               voice=FakeVoiceState(self.voice_channel))
+        self.voice_channel.members.append(self.member)
+
+
+class FakeVoiceClient:
+    """
+    Plays sources like discord.py's AudioPlayer does: one thread per client
+    reading a frame every 20ms, calling ``after`` when the source runs dry or
+    is stopped. It records when each track started and ended.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self._stop = threading.Event()
+        self._thread = None
+        self.started = []
+        self.ended = []
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after):
+        first = True
+        next_frame = time.perf_counter()
+        while not self._stop.is_set():
+            data = source.read()
+            if first:
+                self.started.append(time.perf_counter())
+                first = False
+            if not data:
+                break
+            next_frame += FRAME_DURATION
+            time.sleep(max(0.0, next_frame - time.perf_counter()))
+        self.ended.append(time.perf_counter())
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeContext:
+    def __init__(self, bot, cog, guild):
+        self.bot = bot
+        self.cog = cog
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = guild.member
+        self.message = FakeMessage()
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.cog, self, *args, **kwargs)
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = FakeUser(0, 'TweedlePickle', bot=True)
+        self.shard_id = None
+
+    async def wait_until_ready(self):
+        pass
+
+    def is_closed(self):
+        return False
+
+    def get_guild(self, guild_id):
+        return None
+
+
+class LagMonitor:
+    """Samples how late the event loop wakes up from a short sleep."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - before - self.interval)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def rss_bytes():
+    """Resident memory of this process, where /proc has it."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+async def run_round(bot, cog, guild_count, args, round_number):
+    guilds = [FakeGuild(round_number * 1_000_000 + i) for i in range(guild_count)]
+    monitor = LagMonitor()
+    memory_before = rss_bytes()
+    monitor.start()
+
+    requested = {}
+    commands_started = time.perf_counter()
+
+    async def listen(guild):
+        ctx = FakeContext(bot, cog, guild)
+        for track in range(args.tracks):
+            if track == 0:
+                requested[guild.id] = time.perf_counter()
+            await ctx.invoke(cog.play, search=f'round {round_number} guild {guild.id} '
+                                              f'track {track}')
+
+    await asyncio.gather(*(listen(guild) for guild in guilds))
+    commands_elapsed = time.perf_counter() - commands_started
+    memory_after = rss_bytes()
+
+    # Let every queue play out
+    deadline = time.perf_counter() + args.tracks * (args.duration + 10) + 30
+    while time.perf_counter() < deadline:
+        if all(guild.voice_client is not None and
+               len(guild.voice_client.ended) >= args.tracks for guild in guilds):
+            break
+        await asyncio.sleep(0.1)
+    monitor.stop()
+
+    first_audio, gaps = [], []
+    for guild in guilds:
+        vc = guild.voice_client
+        if vc is None or not vc.started:
+            continue
+        first_audio.append(vc.started[0] - requested[guild.id])
+        gaps.extend(start - end for start, end in zip(vc.started[1:], vc.ended))
+    played = sum(len(g.voice_client.ended) for g in guilds if g.voice_client is not None)
+
+    for guild in guilds:
+        await cog.cleanup(guild)
+
+    per_player = None
+    if memory_before is not None and memory_after is not None:
+        per_player = (memory_after - memory_before) / guild_count
+    return {
+        'guilds': guild_count,
+        'commands_per_second': guild_count * args.tracks / commands_elapsed,
+        'first_audio': first_audio,
+        'gaps': gaps,
+        'played': played,
+        'expected': guild_count * args.tracks,
+        'memory_per_player': per_player,
+        'lag': monitor.samples,
+    }
+
+
+def report(result):
+    def ms(value):
+        return f'{value * 1000:8.1f}'
+
+    memory = result['memory_per_player']
+    memory = f'{memory / 1024:8.1f}' if memory is not None else '       ?'
+    print(f"{result['guilds']:>7} {result['commands_per_second']:>9.1f} "
+          f"{ms(percentile(result['first_audio'], .5))} "
+          f"{ms(percentile(result['first_audio'], .95))} "
+          f"{ms(percentile(result['first_audio'], .99))} "
+          f"{ms(percentile(result['gaps'], .5))} {ms(percentile(result['gaps'], .95))} "
+          f"{memory} {ms(percentile(result['lag'], .5))} {ms(percentile(result['lag'], .99))} "
+          f"{ms(max(result['lag'], default=0))} "
+          f"{result['played']:>6}/{result['expected']}")
+
+
+async def main(args):
+    fixture = make_fixture(args.duration)
+    FakeExtractor(fixture, args.duration, catalog=args.catalog,
+                  extract_latency=args.extract_latency,
+                  download_latency=args.download_latency).install()
+
+    loop = asyncio.get_event_loop()
+    bot = FakeBot(loop)
+    cog = music.Music(bot)
+
+    print(f'{"guilds":>7} {"cmds/s":>9} {"ttfa p50":>8} {"ttfa p95":>8} {"ttfa p99":>8} '
+          f'{"gap p50":>8} {"gap p95":>8} {"KiB/plr":>8} {"lag p50":>8} {"lag p99":>8} '
+          f'{"lag max":>8} {"played":>13}')
+    print('(times in ms)')
+    for round_number, guild_count in enumerate(args.guilds, 1):
+        report(await run_round(bot, cog, guild_count, args, round_number))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Offline load test for the Music cog.')
+    parser.add_argument('--guilds', default='10,50,100',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated guild counts to run, one round each')
+    parser.add_argument('--tracks', type=int, default=3, help='tracks queued per guild')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='length of every track, in seconds')
+    parser.add_argument('--catalog', type=int, default=100000,
+                        help='distinct tracks the searches map onto')
+    parser.add_argument('--extract-latency', type=float, default=0.3,
+                        help='mean seconds a fake extraction takes')
+    parser.add_argument('--download-latency', type=float, default=1.0,
+                        help='mean seconds a fake download takes on top of extracting')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.get_event_loop().run_until_complete(main(parse_args(sys.argv[1:])))
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
@@ -0,0 +1,333 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# The parts of a youtube_dl info dict worth keeping once a track is on disk.
+# Everything else (formats, http headers, ...) only matters while extracting.
+# gain_db is our own: the loudness correction measured for the track, of
+# which baked_gain_db has been applied to the cached file itself. peak_db is
+# the track's own true peak, which the correction is held down by.
+METADATA_KEYS = ('id', 'extractor', 'title', 'alt_title', 'creator', 'uploader',
+                 'duration', 'view_count', 'like_count', 'dislike_count', 'thumbnail',
+                 'webpage_url', 'tags', 'ext', 'gain_db', 'baked_gain_db', 'peak_db')
+# Files in the download directory that aren't downloads: SQLite databases and
+# their journals, and snapshots of the in-memory caches
+KEEP_SUFFIXES = ('.db', '.db-wal', '.db-shm', '.db-journal', '.json')
+
+
+class DownloadCache:
+    """
+    A persistent index of downloaded tracks.
+
+    Entries are keyed by extractor and video id and hold the path of the
+    downloaded file plus the metadata youtube_dl extracted for it, so a track
+    that is already on disk can be played again without another extraction.
+    The index lives in a SQLite database next to the downloads and survives
+    restarts.
+
+    The directory is kept within a byte budget and a maximum age (either can
+    be 0 to disable it). :meth:`evict` removes the least recently played files
+    first, skipping anything still in use. Several processes can share one
+    cache; each publishes what it is using with :meth:`pin`, and pins that
+    haven't been refreshed for ``pin_ttl`` seconds are ignored.
+
+    Files the index doesn't know (partial downloads left by a failure or a
+    crash, downloads from before there was an index) are deleted once they
+    haven't changed for ``orphan_age`` seconds.
+    """
+
+    def __init__(self, directory, filename='cache.db', *, max_bytes=0, max_age=0,
+                 pin_ttl=6 * 60 * 60, orphan_age=24 * 60 * 60):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.pin_ttl = pin_ttl
+        self.orphan_age = orphan_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.swept_bytes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, filename),
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tracks ('
+                         'key TEXT PRIMARY KEY, path TEXT NOT NULL, '
+                         'data TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'added REAL NOT NULL, last_played REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tracks_last_played '
+                         'ON tracks (last_played)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pins ('
+                         'owner TEXT NOT NULL, key TEXT NOT NULL, updated REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pins_owner ON pins (owner)')
+
+    @staticmethod
+    def key(extractor, video_id):
+        """Build the cache key for a video."""
+        return f'{extractor}-{video_id}'
+
+    def get(self, key):
+        """Return ``(path, data)`` for a cached track, or None on a miss."""
+        with self._lock:
+            row = self._db.execute('SELECT path, data FROM tracks WHERE key = ?',
+                                   (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        path, data = row
+        if not os.path.exists(path):
+            # Somebody cleaned up the file behind our back.
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path, json.loads(data)
+
+    def put(self, key, path, data):
+        """Record a downloaded file and its metadata."""
+        data = {k: data.get(k) for k in METADATA_KEYS}
+        size = os.path.getsize(path)
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO tracks '
+                             '(key, path, data, size, added, last_played) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, path, json.dumps(data), size, now, now))
+
+    def touch(self, key):
+        """Mark a track as just played."""
+        with self._lock:
+            self._db.execute('UPDATE tracks SET last_played = ? WHERE key = ?',
+                             (time.time(), key))
+
+    def tracks(self):
+        """``(key, data)`` for every cached track."""
+        with self._lock:
+            rows = self._db.execute('SELECT key, data FROM tracks').fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def sizes(self, keys):
+        """The size in bytes of each of ``keys`` that is cached, by key."""
+        keys = list(keys)
+        sizes = {}
+        with self._lock:
+            # A few hundred at a time, to stay under SQLite's parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                sizes.update(self._db.execute(
+                    f'SELECT key, size FROM tracks WHERE key IN ({placeholders})', chunk))
+        return sizes
+
+    def remove(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM tracks WHERE key = ?', (key,))
+
+    def pin(self, owner, keys):
+        """Replace the set of keys ``owner`` (one process) is using."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM pins WHERE owner = ?', (owner,))
+            self._db.executemany('INSERT INTO pins (owner, key, updated) VALUES (?, ?, ?)',
+                                 [(owner, key, now) for key in keys])
+            self._db.execute('COMMIT')
+
+    def evict(self, pinned=()):
+        """
+        Delete files until the cache is within its budget and age limits.
+
+        ``pinned`` is a collection of keys that must be kept because they are
+        queued or playing, on top of anything pinned by other processes.
+        Returns the keys that were evicted.
+        """
+        self.sweep()
+        now = time.time()
+        evicted = []
+        with self._lock:
+            pinned = set(pinned).union(key for key, in self._db.execute(
+                'SELECT key FROM pins WHERE updated > ?', (now - self.pin_ttl,)))
+            total, = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM tracks').fetchone()
+            rows = self._db.execute('SELECT key, path, size, last_played FROM tracks '
+                                    'ORDER BY last_played').fetchall()
+
+        for key, path, size, last_played in rows:
+            expired = self.max_age and now - last_played > self.max_age
+            over_budget = self.max_bytes and total > self.max_bytes
+            if not (expired or over_budget):
+                # Rows are oldest first, so nothing after this one qualifies either.
+                break
+            if key in pinned:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.remove(key)
+            total -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+            evicted.append(key)
+        return evicted
+
+    def sweep(self):
+        """Delete the files in the directory that aren't indexed and are old enough."""
+        with self._lock:
+            indexed = {os.path.abspath(path)
+                       for path, in self._db.execute('SELECT path FROM tracks')}
+        cutoff = time.time() - self.orphan_age
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(KEEP_SUFFIXES) or \
+                    os.path.abspath(entry.path) in indexed:
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    # Maybe still being written, or about to be indexed
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.swept_bytes += stat.st_size
+
+    def stats(self):
+        """Counters for sizing the cache."""
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                                             'FROM tracks').fetchone()
+        return {
+            'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes,
+            'swept_bytes': self.swept_bytes
+        }
+
+
+def normalize_query(query):
+    """Fold trivially different spellings of a search onto one key."""
+    query = ' '.join(query.split())
+    if '://' in query:
+        # URLs (and the video ids in them) are case sensitive
+        return query
+    return re.sub(r'[^\w ]', '', query.lower())
+
+
+class ExpiringLRU:
+    """
+    A size-bounded LRU mapping where every entry has its own expiry time.
+
+    Expired entries are dropped when they are looked up.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, margin=0):
+        """Return the value for key if it is still valid ``margin`` seconds from now."""
+        try:
+            value, expires = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires - time.time() <= margin:
+            if expires <= time.time():
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snapshot(self):
+        """The entries that are still valid, oldest first, as ``[key, value, expires]``."""
+        now = time.time()
+        return [[key, value, expires] for key, (value, expires) in self._entries.items()
+                if expires > now]
+
+    def restore(self, entries):
+        """
+        Put back entries from :meth:`snapshot` (from before a restart, say),
+        skipping any that have expired or been replaced since. Returns how
+        many were restored.
+        """
+        now = time.time()
+        restored = 0
+        for key, value, expires in entries:
+            if expires > now and key not in self._entries:
+                ExpiringLRU.put(self, key, value, expires)
+                restored += 1
+        return restored
+
+
+class QueryCache(ExpiringLRU):
+    """
+    Remembers what searches and URLs resolved to, for ``ttl`` seconds.
+
+    Values are trimmed metadata dicts, which include the video id. Given a
+    database path, entries are also written through to SQLite and looked up
+    there on a memory miss, so they survive restarts.
+    """
+
+    def __init__(self, size, ttl, *, path=None):
+        super().__init__(size)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS queries ('
+                             'query TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                             'expires REAL NOT NULL)')
+            with self._lock:
+                self._db.execute('DELETE FROM queries WHERE expires <= ?', (time.time(),))
+
+    def get(self, query, margin=0):
+        query = normalize_query(query)
+        data = super().get(query, margin)
+        if data is not None or self._db is None:
+            return data
+
+        with self._lock:
+            row = self._db.execute('SELECT data, expires FROM queries WHERE query = ?',
+                                   (query,)).fetchone()
+        if row is None or row[1] - time.time() <= margin:
+            return None
+        # Counted as a miss above, but it's a hit after all
+        self.misses -= 1
+        self.hits += 1
+        data = json.loads(row[0])
+        super().put(query, data, row[1])
+        return data
+
+    def put(self, query, data):
+        query = normalize_query(query)
+        data = {k: data.get(k) for k in METADATA_KEYS}
+        expires = time.time() + self.ttl
+        super().put(query, data, expires)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO queries (query, data, expires) '
+                                 'VALUES (?, ?, ?)', (query, json.dumps(data), expires))
@@ -0,0 +1,185 @@
+import json
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# Indexed fields and how much a word in each counts
+FIELDS = (('title', 3.0), ('alt_title', 3.0), ('creator', 2.0), ('uploader', 2.0),
+          ('tags', 1.0))
+# Fields that name the track; a query should say most of one of them
+NAME_FIELDS = ('title', 'alt_title')
+# Kept with each track to list it in search results
+STORED = ('id', 'extractor', 'title', 'alt_title', 'creator', 'uploader', 'tags',
+          'duration', 'thumbnail', 'webpage_url')
+# Tracks scored by their words before they are ranked by confidence
+CANDIDATES = 20
+# What confidence is multiplied by for each query word no cached track has
+UNKNOWN_WORD_PENALTY = .25
+
+
+def terms(text):
+    """The lowercase, accent-free words in some text."""
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r'\w+', text)
+
+
+def rarity(total, count):
+    """How telling a word found in ``count`` of ``total`` tracks is (BM25's idf)."""
+    return math.log(1 + (total - count + .5) / (count + .5))
+
+
+def field_terms(data, field):
+    value = data.get(field)
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(map(str, value))
+    return terms(value) if value else []
+
+
+class Catalog:
+    """
+    A full-text index over the metadata of cached tracks, for finding them
+    without asking YouTube.
+
+    The index is inverted: a SQLite table of (word, track, weight) rows, the
+    weight adding up how often and in which fields the word appears, so a
+    search only reads the rows for its own words. Tracks are added as their
+    downloads finish and removed when they are evicted.
+
+    Hits are ranked by a confidence between 0 and 1: the square of the share
+    of the query the track matches, times the square root of how much of the
+    track's title or alt title the query covers, with words weighted by how
+    rare they are in the catalog. Every query word that no cached track has
+    cuts it down further, since the query is then likely after something the
+    catalog doesn't hold (another version, say). For "Luis Fonsi - Despacito
+    ft. Daddy Yankee", "luis fonsi despacito" scores about 0.7, "despacito"
+    alone under 0.5 and "despacito acoustic" well under 0.1.
+    """
+
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS catalog_tracks ('
+                         'key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS catalog_terms ('
+                         'term TEXT NOT NULL, key TEXT NOT NULL, weight REAL NOT NULL, '
+                         'PRIMARY KEY (term, key)) WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS catalog_terms_key ON catalog_terms (key)')
+
+    def add(self, key, data):
+        """Index (or reindex) a track's metadata."""
+        weights = {}
+        for field, weight in FIELDS:
+            for term in field_terms(data, field):
+                weights[term] = weights.get(term, 0) + weight
+        data = {k: data.get(k) for k in STORED}
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM catalog_terms WHERE key = ?', (key,))
+            self._db.execute('INSERT OR REPLACE INTO catalog_tracks (key, data) VALUES (?, ?)',
+                             (key, json.dumps(data)))
+            self._db.executemany('INSERT INTO catalog_terms (term, key, weight) '
+                                 'VALUES (?, ?, ?)',
+                                 [(term, key, weight) for term, weight in weights.items()])
+            self._db.execute('COMMIT')
+
+    def remove(self, keys):
+        """Drop tracks from the index, e.g. because they were evicted."""
+        keys = [(key,) for key in keys]
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('DELETE FROM catalog_terms WHERE key = ?', keys)
+            self._db.executemany('DELETE FROM catalog_tracks WHERE key = ?', keys)
+            self._db.execute('COMMIT')
+
+    def sync(self, tracks):
+        """
+        Make the index match ``tracks``, ``(key, data)`` for everything that is
+        cached: index what is missing and drop what is gone. Returns how many
+        tracks were added.
+        """
+        tracks = dict(tracks)
+        with self._lock:
+            indexed = {key for key, in self._db.execute('SELECT key FROM catalog_tracks')}
+        self.remove(indexed - tracks.keys())
+        missing = tracks.keys() - indexed
+        for key in missing:
+            self.add(key, tracks[key])
+        return len(missing)
+
+    def _select(self, query, values):
+        # Runs ``query`` with an IN (...) of values, a few hundred at a time to
+        # stay under SQLite's parameter limit (called with the lock held).
+        values = list(values)
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            yield from self._db.execute(query.format(', '.join('?' * len(chunk))), chunk)
+
+    def search(self, query, limit=10):
+        """
+        The tracks best matching a query, best first, as dicts with the
+        track's ``key``, its stored ``data``, ``score`` and ``confidence``.
+        """
+        words = list(dict.fromkeys(terms(query)))
+        if not words:
+            return []
+        with self._lock:
+            total, = self._db.execute('SELECT COUNT(*) FROM catalog_tracks').fetchone()
+            rows = list(self._select('SELECT key, term, weight FROM catalog_terms '
+                                     'WHERE term IN ({})', words))
+        if not rows:
+            return []
+
+        counts = {}
+        for key, term, weight in rows:
+            counts[term] = counts.get(term, 0) + 1
+        idf = {word: rarity(total, counts.get(word, 0)) for word in words}
+        unknown = sum(1 for word in words if word not in counts)
+
+        scores = {}
+        matched = {}
+        for key, term, weight in rows:
+            scores[key] = scores.get(key, 0) + idf[term] * weight / (weight + 1)
+            matched.setdefault(key, set()).add(term)
+        candidates = sorted(scores, key=scores.get, reverse=True)[:max(limit, CANDIDATES)]
+
+        with self._lock:
+            stored = {key: json.loads(data) for key, data in self._select(
+                'SELECT key, data FROM catalog_tracks WHERE key IN ({})', candidates)}
+            names = {key: [field_terms(stored[key], field) for field in NAME_FIELDS]
+                     for key in stored}
+            named = {term for fields in names.values() for field in fields for term in field}
+            counts.update(self._select('SELECT term, COUNT(*) FROM catalog_terms '
+                                       'WHERE term IN ({}) GROUP BY term', named - idf.keys()))
+        for term in named - idf.keys():
+            idf[term] = rarity(total, counts.get(term, 0))
+
+        asked = set(words)
+        query_weight = sum(idf[word] for word in words)
+        hits = []
+        for key in candidates:
+            if key not in stored:
+                continue
+            recall = sum(idf[term] for term in matched[key]) / query_weight
+            precision = max((sum(idf[term] for term in set(field) & asked) /
+                             sum(idf[term] for term in set(field))
+                             for field in names[key] if field), default=0)
+            hits.append({'key': key, 'data': stored[key], 'score': scores[key],
+                         'confidence': recall ** 2 * math.sqrt(precision) *
+                                       UNKNOWN_WORD_PENALTY ** unknown})
+        hits.sort(key=lambda hit: (hit['confidence'], hit['score']), reverse=True)
+        return hits[:limit]
+
+    def resolve(self, query, threshold):
+        """The key of the track a query surely means, or None if no track is a sure match."""
+        hits = self.search(query, limit=1)
+        if hits and hits[0]['confidence'] >= threshold:
+            self.hits += 1
+            return hits[0]['key']
+        self.misses += 1
+        return None
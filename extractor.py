@@ -0,0 +1,255 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# youtube_dl is imported on first use rather than with this module, since
+# importing it imports every one of its extractors, which takes a while.
+
+# Options for the YoutubeDL instances in this process; worker processes get
+# theirs from the pool initializer.
+_options = {}
+_local = threading.local()
+_loaded = threading.Event()
+
+
+def _init_worker(options):
+    global _options
+    _options = options
+
+
+def load():
+    """Import youtube_dl, if it isn't yet; this blocks, so keep it off the event loop."""
+    import youtube_dl.extractor  # noqa: F401
+    _loaded.set()
+
+
+def loaded():
+    """Whether youtube_dl has been imported, so using it won't block."""
+    return _loaded.is_set()
+
+
+def youtube_ie():
+    """youtube_dl's YouTube extractor class."""
+    from youtube_dl.extractor import YoutubeIE
+    return YoutubeIE
+
+
+def worker_ytdl():
+    """The YoutubeDL instance belonging to the current thread (or process)."""
+    ytdl = getattr(_local, 'ytdl', None)
+    if ytdl is None:
+        load()
+        from youtube_dl import YoutubeDL
+        ytdl = _local.ytdl = YoutubeDL(_options)
+    return ytdl
+
+
+def preload():
+    """Get the current worker's YoutubeDL ready ahead of its first job."""
+    worker_ytdl()
+
+
+def info(url):
+    """Extract a URL or search without downloading it."""
+    data = worker_ytdl().extract_info(url, download=False)
+    if 'entries' in data:
+        # take first item from a playlist
+        data = data['entries'][0]
+    return data
+
+
+def download(url):
+    """Download a URL or search, returning ``(path, data)``."""
+    ytdl = worker_ytdl()
+    data = ytdl.extract_info(url, download=True)
+    if 'entries' in data:
+        # take first item from a playlist
+        data = data['entries'][0]
+    return ytdl.prepare_filename(data), data
+
+
+def locate(url):
+    """Extract a URL or search, returning ``(path, data)`` for where it would download to."""
+    data = info(url)
+    return worker_ytdl().prepare_filename(data), data
+
+
+def playlist_entries(url):
+    """
+    Yield the video URLs of a playlist without extracting each video.
+
+    youtube_dl hands back the entries as a generator that fetches further
+    pages as it goes, so this blocks and belongs in an executor.
+    """
+    ytdl = worker_ytdl()
+    YoutubeIE = youtube_ie()
+    result = ytdl.extract_info(url, download=False, process=False)
+    # A watch?v=...&list=... URL first resolves to the playlist URL itself
+    for _ in range(3):
+        if result.get('_type') not in ('url', 'url_transparent') or \
+                result.get('ie_key') == YoutubeIE.ie_key():
+            break
+        result = ytdl.extract_info(result['url'], download=False, process=False,
+                                   ie_key=result.get('ie_key'))
+
+    if 'entries' not in result:
+        yield url
+        return
+
+    for entry in result['entries']:
+        if entry.get('ie_key') == YoutubeIE.ie_key():
+            yield 'https://www.youtube.com/watch?v=' + entry['id']
+        else:
+            yield entry.get('webpage_url') or entry['url']
+
+
+class _Failed:
+    """An exception raised by a walk, passed along to the event loop."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class ExtractorPool:
+    """
+    Runs youtube_dl jobs on a dedicated pool of workers.
+
+    Each worker thread (or process, with ``processes=True``) has its own
+    YoutubeDL instance, since they are not safe to share. Jobs wait in a
+    queue per guild and the workers take from the guilds in turn, so a guild
+    queueing a long playlist can't starve one that wants a single track.
+    Once ``max_pending`` jobs are waiting, :meth:`run` waits for room.
+
+    ``observe``, if set, is called with the name of each finished job, how
+    long it waited for a worker and how long it ran, in seconds.
+
+    Walking a playlist hands back its entries as youtube_dl pages through
+    it, which doesn't fit a job with one result, so :meth:`walk` has
+    ``walkers`` threads of its own; walks beyond that wait their turn.
+    """
+
+    def __init__(self, options, *, workers=4, max_pending=256, processes=False, walkers=2):
+        _init_worker(options)
+        self.options = options
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processes = processes
+        self.walkers = walkers
+        self._walker = ThreadPoolExecutor(walkers, thread_name_prefix='ytdl-walk')
+        self.pending = 0
+        self.active = 0
+        self.observe = None
+        self._executor = None
+        self._queues = OrderedDict()
+        self._changed = None
+        self._dispatchers = []
+
+    def _start(self):
+        if self.processes:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                                 initargs=(self.options,))
+        else:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='ytdl')
+        self._changed = asyncio.Condition()
+        loop = asyncio.get_event_loop()
+        self._dispatchers = [loop.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def run(self, guild_id, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` on a worker on behalf of a guild."""
+        if self._executor is None:
+            self._start()
+
+        future = asyncio.get_event_loop().create_future()
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.pending < self.max_pending)
+            self._queues.setdefault(guild_id, deque()).append(
+                (future, partial(fn, *args, **kwargs), time.perf_counter()))
+            self.pending += 1
+            self._changed.notify_all()
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._queues)
+                # Take one job from the guild at the front, then send that
+                # guild to the back of the rotation if it has more.
+                guild_id, jobs = self._queues.popitem(last=False)
+                future, job, queued = jobs.popleft()
+                if jobs:
+                    self._queues[guild_id] = jobs
+                self.pending -= 1
+                self._changed.notify_all()
+
+            if future.done():
+                # The caller gave up waiting
+                continue
+
+            self.active += 1
+            started = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(self._executor, job)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.active -= 1
+                if self.observe is not None:
+                    self.observe(job.func.__name__, started - queued,
+                                 time.perf_counter() - started)
+
+    async def walk(self, fn, *args):
+        """Run a generator ``fn(*args)`` on a walker thread, yielding its items as they come."""
+        loop = asyncio.get_event_loop()
+        found = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def walk():
+            try:
+                for item in fn(*args):
+                    if stop.is_set():
+                        return
+                    loop.call_soon_threadsafe(found.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(found.put_nowait, _Failed(e))
+            finally:
+                loop.call_soon_threadsafe(found.put_nowait, done)
+
+        loop.run_in_executor(self._walker, walk)
+        try:
+            while True:
+                item = await found.get()
+                if item is done:
+                    return
+                if isinstance(item, _Failed):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+
+    async def warm_up(self):
+        """
+        Have the workers import youtube_dl and build their YoutubeDL instances
+        now, rather than on the first jobs.
+        """
+        if self._executor is None:
+            self._start()
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, preload)
+                               for _ in range(self.workers)))
+
+    def close(self):
+        for task in self._dispatchers:
+            task.cancel()
+        self._walker.shutdown(wait=False)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,136 @@
+import threading
+from collections import deque
+
+import discord
+
+# The most frames a decode keeps; older ones are dropped as new ones come in.
+# Kept frames let a guild that starts the same track later still join in; at
+# 128kbps Opus ten minutes is about 10MB.
+MAX_BUFFERED_FRAMES = 10 * 60 * 50
+# How far past what a decode has decoded a reader may start and still join
+# it, since the frames in between are decoded on the spot (one second)
+JOIN_AHEAD_FRAMES = 50
+
+
+class SharedDecode:
+    """
+    One decoder whose frames any number of readers play at their own pace.
+
+    Frames are decoded on demand by whichever reader is furthest ahead and
+    kept, numbered from ``origin``, up to :data:`MAX_BUFFERED_FRAMES` of
+    them. A reader that falls further behind than that (paused, say, or a
+    prefetched track not started yet) moves to a decode of its own when it
+    next reads.
+    """
+
+    def __init__(self, fanout, key, source, origin):
+        self.fanout = fanout
+        self.key = key
+        self.source = source
+        self.frames = deque()
+        self.base = origin  # number of frames[0]
+        self.finished = False
+        self.closed = False
+        self.readers = set()
+        self._lock = threading.Lock()
+
+    def can_serve(self, position):
+        return (not self.closed and
+                self.base <= position <= self.base + len(self.frames) + JOIN_AHEAD_FRAMES)
+
+    def frame(self, position):
+        """Frame number ``position``, b'' past the end, or None if it was dropped."""
+        with self._lock:
+            if position < self.base:
+                return None
+            while not self.finished and position >= self.base + len(self.frames):
+                data = self.source.read()
+                if not data:
+                    self.finished = True
+                    break
+                self.frames.append(data)
+                if len(self.frames) > MAX_BUFFERED_FRAMES:
+                    self.frames.popleft()
+                    self.base += 1
+            if position >= self.base + len(self.frames):
+                return b''
+            return self.frames[position - self.base]
+
+    def leave(self, reader):
+        with self.fanout.lock:
+            self.readers.discard(reader)
+            if self.readers:
+                return
+            self.closed = True
+            if self.fanout.decodes.get(self.key) is self:
+                del self.fanout.decodes[self.key]
+        self.source.cleanup()
+
+
+class SharedReader(discord.AudioSource):
+    """One guild's place in a :class:`SharedDecode`."""
+
+    def __init__(self, fanout, key, position, factory):
+        self.fanout = fanout
+        self.key = key
+        self.position = position
+        self.factory = factory
+        self.decode = None
+
+    def read(self):
+        data = self.decode.frame(self.position)
+        if data is None:
+            # Left behind; find a decode that has its frames, or start one
+            self.decode.leave(self)
+            self.fanout.join(self)
+            data = self.decode.frame(self.position) or b''
+        self.position += 1
+        return data
+
+    def is_opus(self):
+        return self.decode.source.is_opus()
+
+    def cleanup(self):
+        if self.decode is not None:
+            self.decode.leave(self)
+            self.decode = None
+
+
+class FanOut:
+    """
+    Running decodes by key, so guilds playing the same thing share one.
+
+    The key should say what comes out (the track and its volume); readers
+    that want a frame the running decode no longer has get a decode of
+    their own, which takes over the key.
+    """
+
+    def __init__(self):
+        self.decodes = {}
+        self.lock = threading.Lock()
+
+    def open(self, key, position, factory):
+        """
+        A reader for ``key`` starting at frame ``position``, sharing a running
+        decode if it can serve it, else starting one with ``factory(position)``.
+        """
+        reader = SharedReader(self, key, position, factory)
+        self.join(reader)
+        return reader
+
+    def join(self, reader):
+        """Attach a reader to a decode that can serve it from where it is."""
+        with self.lock:
+            decode = self.decodes.get(reader.key)
+            if decode is None or not decode.can_serve(reader.position):
+                decode = SharedDecode(self, reader.key, reader.factory(reader.position),
+                                      reader.position)
+                self.decodes[reader.key] = decode
+            decode.readers.add(reader)
+            reader.decode = decode
+
+    def stats(self):
+        """How many decodes are running and how many readers they serve."""
+        with self.lock:
+            decodes = list(self.decodes.values())
+        return len(decodes), sum(len(decode.readers) for decode in decodes)
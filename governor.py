@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import math
+import threading
+import time
+from collections import deque
+
+
+class Limit:
+    """
+    A cap on how much of something the bot uses overall and per guild, where
+    a cap of 0 means there is none.
+
+    ``read()`` says how much each guild is using, as a dict by guild id.
+    Readings are reused for ``ttl`` seconds, for things that are costly to
+    add up. ``refused`` counts the times the limit said no.
+    """
+
+    def __init__(self, name, total=0, per_guild=0, *, read=None, ttl=0):
+        self.name = name
+        self.total = total
+        self.per_guild = per_guild
+        self.read = read
+        self.ttl = ttl
+        self.refused = 0
+        self._reading = None
+        self._read_at = 0
+
+    def usage(self):
+        """``(total, by guild)`` of what is in use."""
+        now = time.monotonic()
+        if self._reading is None or now - self._read_at >= self.ttl:
+            self._reading = dict(self.read()) if self.read is not None else {}
+            self._read_at = now
+        return sum(self._reading.values()), self._reading
+
+    def _room(self, used, guild_used):
+        rooms = [cap - n for cap, n in ((self.total, used), (self.per_guild, guild_used)) if cap]
+        return max(0, min(rooms)) if rooms else math.inf
+
+    def room(self, guild_id):
+        """How much more the guild may use."""
+        used, by_guild = self.usage()
+        return self._room(used, by_guild.get(guild_id, 0))
+
+    def allows(self, guild_id, amount=1):
+        """Whether the guild may use ``amount`` more; a no is counted."""
+        if self.room(guild_id) >= amount:
+            return True
+        self.refused += 1
+        return False
+
+    def report(self):
+        used, by_guild = self.usage()
+        return {'name': self.name, 'used': used, 'total': self.total,
+                'busiest': max(by_guild.values(), default=0), 'per_guild': self.per_guild,
+                'refused': self.refused}
+
+
+class Slot:
+    """One unit of a :class:`Pool`, held by a guild until it is released."""
+
+    __slots__ = ('pool', 'guild_id', 'released')
+
+    def __init__(self, pool, guild_id):
+        self.pool = pool
+        self.guild_id = guild_id
+        self.released = False
+
+    def release(self):
+        """Give the slot back, from any thread; releasing it again does nothing."""
+        self.pool._release(self)
+
+
+class Pool(Limit):
+    """
+    A limit on things guilds hold and give back, like running processes.
+
+    Each one held is a :class:`Slot`. :meth:`claim` takes a slot if there is
+    room, for callers that can do without one; :meth:`acquire` waits its turn
+    for one. Waiters are served in order, except that one whose guild is at
+    its own cap doesn't hold up other guilds.
+    """
+
+    def __init__(self, name, total=0, per_guild=0):
+        super().__init__(name, total, per_guild)
+        self.used = 0
+        self.by_guild = {}
+        self.waiting = deque()
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def usage(self):
+        with self._lock:
+            return self.used, dict(self.by_guild)
+
+    def _take(self, guild_id, force=False):
+        # Called with the lock held
+        held = self.by_guild.get(guild_id, 0)
+        if not force and self._room(self.used, held) < 1:
+            return False
+        self.used += 1
+        self.by_guild[guild_id] = held + 1
+        return True
+
+    def claim(self, guild_id, *, force=False):
+        """
+        A slot for the guild, or None if it is at a cap. ``force`` takes one
+        regardless, for what the bot can't do without (it still counts).
+        """
+        with self._lock:
+            took = self._take(guild_id, force)
+        if not took:
+            self.refused += 1
+            return None
+        return Slot(self, guild_id)
+
+    async def acquire(self, guild_id):
+        """Wait for a slot for the guild."""
+        self.loop = asyncio.get_event_loop()
+        future = self.loop.create_future()
+        self.waiting.append((guild_id, future))
+        self._wake()
+        if not future.done():
+            self.refused += 1
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                future.result().release()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def hold(self, guild_id):
+        """Hold a slot for the guild for the duration of an ``async with``."""
+        slot = await self.acquire(guild_id)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def _wake(self):
+        """Hand slots to the waiters, in order, as far as they fit (on the loop)."""
+        full = set()
+        for waiter in list(self.waiting):
+            guild_id, future = waiter
+            if future.done():
+                self.waiting.remove(waiter)
+                continue
+            if guild_id in full:
+                continue
+            with self._lock:
+                took = self._take(guild_id)
+                if not took and self.total and self.used >= self.total:
+                    break
+            if took:
+                self.waiting.remove(waiter)
+                future.set_result(Slot(self, guild_id))
+            else:
+                full.add(guild_id)
+
+    def _release(self, slot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self.used -= 1
+            held = self.by_guild[slot.guild_id] - 1
+            if held:
+                self.by_guild[slot.guild_id] = held
+            else:
+                del self.by_guild[slot.guild_id]
+            loop = self.loop if self.waiting else None
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake)
+
+
+class Governor:
+    """
+    Caps on what every guild's players hold between them, overall and per
+    guild: open audio sources, downloads in flight, queued tracks, and bytes
+    of downloaded tracks queued or playing.
+
+    The governor only counts and says yes or no; what to do at a cap (wait,
+    queue a track without opening it, stream instead of downloading) is up
+    to the caller. :meth:`report` says where each limit stands.
+    """
+
+    def __init__(self, *, decoders=(0, 0), downloads=(0, 0), queue=(0, 0), cache_bytes=(0, 0)):
+        self.decoders = Pool('decoders', *decoders)
+        self.downloads = Pool('downloads', *downloads)
+        self.queue = Limit('queue', *queue)
+        # Adding these up means asking the cache database
+        self.cache_bytes = Limit('cache_bytes', *cache_bytes, ttl=1.0)
+
+    def limits(self):
+        return self.decoders, self.downloads, self.queue, self.cache_bytes
+
+    def report(self):
+        """For each limit: its caps, what is in use, the busiest guild's use and refusals."""
+        return [limit.report() for limit in self.limits()]
@@ -0,0 +1,95 @@
+import json
+import multiprocessing
+import signal
+import time
+import urllib.request
+
+# Worker processes are spawned rather than forked, so none of them inherit
+# the supervisor's state (or anyone's SQLite connections).
+mp = multiprocessing.get_context('spawn')
+
+
+def recommended_shards(token):
+    """Ask Discord how many shards the bot should run, or None if we can't."""
+    request = urllib.request.Request('https://discordapp.com/api/v7/gateway/bot',
+                                     headers={'Authorization': f'Bot {token}',
+                                              'User-Agent': 'TweedlePickle'})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.load(response)['shards']
+    except Exception as e:
+        print(f'Could not fetch the recommended shard count: {e}')
+        return None
+
+
+def run_worker(shard_ids, shard_count):
+    import tweedlePickle
+    tweedlePickle.run(shard_ids=shard_ids, shard_count=shard_count)
+
+
+class Supervisor:
+    """
+    Runs the bot as several processes, each owning a slice of the shards.
+
+    Every worker runs its own bot and Music cog; they share the download
+    cache on disk. A worker that exits is restarted, after a delay that
+    doubles each time it dies soon after starting.
+    """
+
+    def __init__(self, workers, shard_count, *, restart_delay=5, max_restart_delay=300):
+        self.workers = min(workers, shard_count)
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.processes = {}
+        self.delays = {}
+        self.started = {}
+        self.stopping = False
+
+    def shards_of(self, worker):
+        return list(range(worker, self.shard_count, self.workers))
+
+    def start(self, worker):
+        shard_ids = self.shards_of(worker)
+        process = mp.Process(target=run_worker, args=(shard_ids, self.shard_count),
+                             name=f'shards-{worker}')
+        process.start()
+        self.processes[worker] = process
+        self.started[worker] = time.monotonic()
+        print(f'Started worker {worker} (pid {process.pid}) for shards {shard_ids}')
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker in range(self.workers):
+            self.start(worker)
+
+        restarts = {}  # worker -> when to restart it
+        while not self.stopping:
+            now = time.monotonic()
+            for worker, process in self.processes.items():
+                if process.is_alive() or worker in restarts:
+                    continue
+                delay = self.delays.get(worker, self.restart_delay)
+                if now - self.started[worker] > self.max_restart_delay:
+                    # It ran for a good while, so this isn't a crash loop
+                    delay = self.restart_delay
+                print(f'Worker {worker} exited with {process.exitcode}, '
+                      f'restarting in {delay}s')
+                restarts[worker] = now + delay
+                self.delays[worker] = min(delay * 2, self.max_restart_delay)
+
+            for worker, when in list(restarts.items()):
+                if now >= when:
+                    del restarts[worker]
+                    self.start(worker)
+            time.sleep(1)
+
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
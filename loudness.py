@@ -0,0 +1,48 @@
+import json
+import math
+import re
+import subprocess
+
+
+# How close to full scale a track's true peak may be brought, in dBTP
+PEAK_CEILING = -1.0
+
+
+def measure(path):
+    """
+    The integrated loudness of a file in LUFS (EBU R128) and its true peak
+    in dBTP, each None for silence.
+
+    Decodes the whole file in FFmpeg, so it blocks for a while.
+    """
+    result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', path, '-vn',
+                             '-af', 'loudnorm=print_format=json', '-f', 'null', '-'],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, check=True)
+    # loudnorm prints its measurements as a JSON object at the end of the log
+    match = re.search(rb'\{[^{}]*"input_i"[^{}]*\}', result.stderr)
+    if match is None:
+        return None, None
+    stats = json.loads(match.group())
+    lufs, peak = (float(stats.get(name, '-inf')) for name in ('input_i', 'input_tp'))
+    return (lufs if math.isfinite(lufs) else None,
+            peak if math.isfinite(peak) else None)
+
+
+def gain_db(lufs, target, max_boost, peak=None, volume=1.0):
+    """
+    The gain that brings a track measured at ``lufs`` to the target loudness,
+    held down so that played at ``volume`` its true peak stays under
+    :data:`PEAK_CEILING`.
+    """
+    if lufs is None:
+        return 0.0
+    gain = min(target - lufs, max_boost)
+    if peak is not None:
+        gain = min(gain, PEAK_CEILING - peak - 20 * math.log10(volume))
+    return round(gain, 2)
+
+
+def ratio(db):
+    """A gain in dB as an amplitude multiplier."""
+    return 10 ** (db / 20)
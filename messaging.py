@@ -0,0 +1,212 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+
+import discord
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` requests every ``per`` seconds, with bursts up to ``rate``.
+
+    :meth:`acquire` reserves a token straight away and sleeps until it is
+    due, so waiters are served in order without a queue of their own.
+    """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = None
+
+    def reserve(self, now):
+        """Take a token, returning how long to wait before using it."""
+        if self.updated is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens * self.per / self.rate
+
+    async def acquire(self):
+        delay = self.reserve(asyncio.get_event_loop().time())
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class _Op:
+    __slots__ = ('kind', 'ready', 'embed', 'content', 'delete_after', 'fresh', 'items',
+                 'render', 'message', 'emoji')
+
+    def __init__(self, kind, ready, **fields):
+        self.kind = kind
+        self.ready = ready
+        for name in self.__slots__[2:]:
+            setattr(self, name, fields.get(name))
+
+
+class Outbox:
+    """
+    Messages waiting to go out to one channel, sent one at a time.
+
+    Pending messages are keyed, so a newer update to the same thing replaces
+    one that hasn't been sent yet: while the channel is rate limited, five
+    track changes become one edit. Messages kept under a key (like the now
+    playing message) are edited in place rather than deleted and resent.
+    """
+
+    def __init__(self, messenger, channel):
+        self.messenger = messenger
+        self.channel = channel
+        self.pending = OrderedDict()
+        self.messages = {}
+        # Discord allows 5 messages per 5 seconds per channel, and reactions
+        # one at a time every quarter second.
+        self.bucket = TokenBucket(5, 5.0)
+        self.reactions = TokenBucket(1, 0.25)
+        self.task = None
+        self.sending = None  # key of the message going out right now
+        self._wake = asyncio.Event()
+
+    def submit(self, key, op):
+        self.pending[key] = op
+        self._wake.set()
+        if self.task is None:
+            self.task = self.messenger.loop.create_task(self._run())
+
+    async def _run(self):
+        loop = self.messenger.loop
+        try:
+            while self.pending:
+                now = loop.time()
+                key = next((k for k, op in self.pending.items() if op.ready <= now), None)
+                if key is None:
+                    # Only summaries still collecting; wait for one to be due
+                    self._wake.clear()
+                    soonest = min(op.ready for op in self.pending.values())
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), soonest - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                # Wait for the rate limit before taking the message off the
+                # queue, so anything sent for it meanwhile is folded in.
+                bucket = self.reactions if self.pending[key].kind == 'react' else self.bucket
+                await bucket.acquire()
+                await self.messenger.bucket.acquire()
+                op = self.pending.pop(key)
+                self.sending = key
+                try:
+                    await self._perform(key, op)
+                except discord.HTTPException as e:
+                    print(f'Could not {op.kind} a message in {self.channel}: {e}')
+                finally:
+                    self.sending = None
+        finally:
+            self.task = None
+            if not self.pending and not self.messages:
+                self.messenger.outboxes.pop(self.channel.id, None)
+
+    async def _perform(self, key, op):
+        if op.kind == 'send':
+            await self.channel.send(op.content, embed=op.embed, delete_after=op.delete_after)
+        elif op.kind == 'summary':
+            await self.channel.send(embed=op.render(op.items))
+        elif op.kind == 'react':
+            await op.message.add_reaction(op.emoji)
+        elif op.kind == 'edit':
+            await op.message.edit(embed=op.embed, delete_after=op.delete_after)
+        elif op.kind == 'show':
+            message = self.messages.get(key)
+            if message is not None and op.fresh:
+                # Send it again at the bottom of the channel
+                self.messages.pop(key)
+                try:
+                    await message.delete()
+                except discord.HTTPException:
+                    pass
+                message = None
+            if message is not None:
+                try:
+                    return await message.edit(embed=op.embed)
+                except discord.NotFound:
+                    pass
+            self.messages[key] = await self.channel.send(embed=op.embed)
+        elif op.kind == 'clear':
+            message = self.messages.pop(key, None)
+            if message is not None:
+                try:
+                    await message.delete()
+                except discord.NotFound:
+                    pass
+
+
+class Messenger:
+    """
+    Sends the bot's messages without holding up playback or commands.
+
+    Everything is queued per channel (see :class:`Outbox`) and goes out in
+    the background, within Discord's per-channel limits and an overall
+    request rate for the whole bot.
+    """
+
+    def __init__(self, loop, *, rate=45, batch_delay=1.5):
+        self.loop = loop
+        self.bucket = TokenBucket(rate, 1.0)
+        self.batch_delay = batch_delay
+        self.outboxes = {}
+        self._ids = itertools.count()
+
+    def outbox(self, channel):
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self.outboxes[channel.id] = Outbox(self, channel)
+        return outbox
+
+    def send(self, channel, content=None, *, embed=None, delete_after=None):
+        """Send a message."""
+        self.outbox(channel).submit(('send', next(self._ids)), _Op(
+            'send', self.loop.time(), content=content, embed=embed, delete_after=delete_after))
+
+    def show(self, channel, key, embed, *, fresh=False):
+        """
+        Show ``embed`` in the channel's message for ``key``, editing it if it's
+        there already; ``fresh`` sends it anew so it is the latest message.
+        """
+        outbox = self.outbox(channel)
+        previous = outbox.pending.get(key)
+        fresh = fresh or (previous is not None and previous.kind == 'show' and previous.fresh)
+        outbox.submit(key, _Op('show', self.loop.time(), embed=embed, fresh=fresh))
+
+    def clear(self, channel, key):
+        """Delete the channel's message for ``key``, if it has one."""
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None or (key not in outbox.messages and key not in outbox.pending
+                              and outbox.sending != key):
+            return
+        outbox.submit(key, _Op('clear', self.loop.time()))
+
+    def summarize(self, channel, key, item, render):
+        """
+        Add an item to a summary that goes out ``batch_delay`` seconds after
+        the first one, as ``render(items)``.
+        """
+        outbox = self.outbox(channel)
+        op = outbox.pending.get(key)
+        if op is not None and op.kind == 'summary':
+            op.items.append(item)
+            return
+        outbox.submit(key, _Op('summary', self.loop.time() + self.batch_delay, items=[item],
+                               render=render))
+
+    def react(self, message, emoji):
+        """Add a reaction to a message."""
+        self.outbox(message.channel).submit(('react', next(self._ids)), _Op(
+            'react', self.loop.time(), message=message, emoji=emoji))
+
+    def edit(self, message, embed, *, delete_after=None):
+        """Edit a message; a later edit of the same message replaces this one."""
+        self.outbox(message.channel).submit(('edit', message.id), _Op(
+            'edit', self.loop.time(), message=message, embed=embed, delete_after=delete_after))
@@ -0,0 +1,182 @@
+import asyncio
+import bisect
+import math
+import threading
+
+# Upper bounds (seconds) of the latency buckets, from a frame to a long download
+LATENCY_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, per set of labels.
+
+    Observations may come from any thread (e.g. the audio thread).
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def quantile(self, q, **labels):
+        """An estimate of a quantile: the upper bound of the bucket it falls in."""
+        with self._lock:
+            series = self._series.get(tuple(sorted(labels.items())))
+            counts = list(series[0]) if series else []
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+
+    def summary(self):
+        """``(labels, count, sum)`` of every series."""
+        with self._lock:
+            return [(dict(key), sum(counts), total)
+                    for key, (counts, total) in self._series.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(key + (("le", _number(bound)),))} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{_labels(key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(key)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """
+    A value read from a callback whenever the metrics are collected.
+
+    The callback returns a number, or a dict of numbers keyed by a label value.
+    ``kind`` is 'counter' for a running total kept elsewhere (e.g. cache hits).
+    """
+
+    def __init__(self, name, help, read, *, label=None, kind='gauge'):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def values(self):
+        value = self.read()
+        if isinstance(value, dict):
+            return [(((self.label, k),), v) for k, v in value.items()]
+        return [((), value)]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{self.name}{_labels(key)} {_number(value)}'
+                     for key, value in self.values())
+        return lines
+
+
+class Registry:
+    """Holds the bot's metrics and serves them in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, help, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name, help, read, *, label=None):
+        gauge = Gauge(name, help, read, label=label)
+        self.metrics.append(gauge)
+        return gauge
+
+    def counter(self, name, help, read, *, label=None):
+        counter = Gauge(name, help, read, label=label, kind='counter')
+        self.metrics.append(counter)
+        return counter
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f'Could not collect {metric.name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+    def log_line(self):
+        """A one line summary: every gauge, and the count and p50/p95 of every histogram."""
+        parts = []
+        for metric in self.metrics:
+            if isinstance(metric, Gauge):
+                for key, value in metric.values():
+                    parts.append(f'{metric.name}{_labels(key)}={_number(value)}')
+                continue
+            for labels, count, total in metric.summary():
+                p50 = metric.quantile(.5, **labels)
+                p95 = metric.quantile(.95, **labels)
+                parts.append(f'{metric.name}{_labels(tuple(sorted(labels.items())))}='
+                             f'n:{count} p50:{_number(p50)} p95:{_number(p95)}')
+        return ' '.join(parts)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """Serve ``GET /metrics`` on a local port."""
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def log_loop(self, interval):
+        """Print the summary line every ``interval`` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            print(f'metrics: {self.log_line()}')
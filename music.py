@@ -1,20 +1,40 @@
+import startup  # first, so the startup timings include importing everything else
 import discord
 from discord.ext import commands
 import asyncio
-from async_timeout import timeout
+import audioop
+import math
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from youtube_dl import YoutubeDL
 import re
-import urllib.request
-import urllib.error
-import youtube_dl
+import threading
+from urllib.parse import urlparse, parse_qs
 import os
+import time
+import weakref
+
+import extractor
+import fanout
+import loudness
+import messaging
+import metrics
+import opus
+import settings
+import tee
+import watchdog
+from cache import METADATA_KEYS, DownloadCache, ExpiringLRU, QueryCache
+from catalog import Catalog
+from governor import Governor
+from queue_store import QueueStore
+from timers import TimerWheel
+from track_queue import TrackQueue
+from votes import NO, YES, VoteBook
 
 #origin: https://gist.github.com/NoirPi/0e1378b868d843a2d6e00180921f35dd
 
 ytdlopts = {
     'format': 'bestaudio/best',
-    'outtmpl': 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'outtmpl': os.path.join(settings.DOWNLOAD_DIR, '%(extractor)s-%(id)s-%(title)s.%(ext)s'),
     'restrictfilenames': True,
     'noplaylist': False,
     'nocheckcertificate': True,
@@ -26,7 +46,199 @@ ytdlopts = {
     'source_address': '0.0.0.0'
 }
 
-ytdl = YoutubeDL(ytdlopts)
+ytdl = extractor.ExtractorPool(ytdlopts, workers=settings.EXTRACT_WORKERS,
+                              max_pending=settings.EXTRACT_MAX_PENDING,
+                              processes=settings.EXTRACT_PROCESSES,
+                              walkers=settings.EXTRACT_PLAYLIST_WORKERS)
+cache = DownloadCache(settings.DOWNLOAD_DIR, max_bytes=settings.CACHE_MAX_BYTES,
+                      max_age=settings.CACHE_MAX_AGE)
+# What searches and URLs resolved to, and the signed stream URLs of videos
+queries = QueryCache(settings.QUERY_CACHE_SIZE, settings.QUERY_CACHE_TTL,
+                     path=os.path.join(settings.DOWNLOAD_DIR, 'cache.db')
+                     if settings.QUERY_CACHE_PERSIST else None)
+streams = ExpiringLRU(settings.STREAM_CACHE_SIZE)
+# The in-memory caches saved across restarts
+warm = {'queries': queries, 'streams': streams}
+# A full-text index of the cached tracks, to find them without searching YouTube
+catalog = Catalog(os.path.join(settings.DOWNLOAD_DIR, 'cache.db'))
+
+# Players start at this volume, and it is baked into the Opus cache so the
+# files can be sent as they are at the default volume.
+DEFAULT_VOLUME = .5
+# Every guild's queue and playback state, so they survive a restart
+queues = QueueStore(settings.STATE_PATH)
+transcoder = ThreadPoolExecutor(settings.TRANSCODE_WORKERS, thread_name_prefix='transcode')
+transcoding = set()
+# Downloads that are being played while they download, by cache key
+downloading = {}
+# FFmpeg decodes shared by the guilds playing the same track at the same level
+shared = fanout.FanOut()
+# Caps on what the players hold between them; the cog tells it how to add up
+# queued tracks and bytes
+governor = Governor(decoders=(settings.MAX_DECODERS, settings.GUILD_MAX_DECODERS),
+                    downloads=(settings.MAX_DOWNLOADS, settings.GUILD_MAX_DOWNLOADS),
+                    queue=(settings.MAX_QUEUED, settings.GUILD_MAX_QUEUED),
+                    cache_bytes=(settings.CACHE_MAX_BYTES, settings.GUILD_CACHE_MAX_BYTES))
+
+# Latency histograms; the cog adds its gauges and serves them all
+registry = metrics.Registry()
+extract_seconds = registry.histogram('tweedle_extract_seconds',
+                                     'Time youtube_dl spent extracting, by job')
+extract_wait_seconds = registry.histogram('tweedle_extract_wait_seconds',
+                                          'Time extraction jobs waited for a worker')
+download_seconds = registry.histogram('tweedle_download_seconds',
+                                      'Time taken to download a track, by method')
+first_audio_seconds = registry.histogram('tweedle_first_audio_seconds',
+                                         'Time from a play command to the first audio '
+                                         'frame, when nothing was playing')
+track_gap_seconds = registry.histogram('tweedle_track_gap_seconds',
+                                       'Silence between a track ending and the queued '
+                                       'one starting')
+queue_wait_seconds = registry.histogram('tweedle_queue_wait_seconds',
+                                        'Time tracks spent queued before playing')
+loop_lag_seconds = registry.histogram('tweedle_loop_lag_seconds',
+                                      'How late the event loop woke up from a sleep')
+blocked_seconds = registry.histogram('tweedle_blocked_seconds',
+                                     'Callbacks that blocked the event loop past the '
+                                     'watchdog threshold, by command')
+# How many queued songs ~queue lists per page
+QUEUE_PAGE_SIZE = 10
+# How many players reconnect at once after a restart
+RESTORE_CONCURRENCY = 8
+# How long each step of starting up took
+phases = startup.Phases()
+
+
+def observe_job(name, waited, ran):
+    extract_wait_seconds.observe(waited)
+    if name == 'download':
+        download_seconds.observe(ran, method='youtube_dl')
+    else:
+        extract_seconds.observe(ran, job=name)
+
+
+ytdl.observe = observe_job
+
+
+def cache_key(search):
+    """Work out the cache key for a search without extracting it, if possible."""
+    if not extractor.loaded():
+        # Not worth holding up the event loop to import youtube_dl for
+        return None
+    YoutubeIE = extractor.youtube_ie()
+    if YoutubeIE.suitable(search):
+        return DownloadCache.key(YoutubeIE.IE_NAME, YoutubeIE.extract_id(search))
+    return None
+
+
+def stream_expiry(url):
+    """The unix time a signed stream URL stops working, if it says."""
+    expire = parse_qs(urlparse(url).query).get('expire')
+    if not expire:
+        # DASH manifests put their parameters in the path instead
+        match = re.search(r'/expire/(\d+)', url)
+        expire = match and [match.group(1)]
+    try:
+        return int(expire[0]) if expire else None
+    except ValueError:
+        return None
+
+
+def remember_stream(data):
+    """Keep a resolved stream URL around until its signature expires."""
+    expires = stream_expiry(data['url'])
+    if expires is not None:
+        metadata = {k: data.get(k) for k in METADATA_KEYS}
+        streams.put(DownloadCache.key(data['extractor'], data['id']),
+                    (data['url'], metadata), expires)
+
+
+def store_download(path, data):
+    """Add a fresh download to the cache and queue its conversion to Opus."""
+    key = DownloadCache.key(data['extractor'], data['id'])
+    cache.put(key, path, data)
+    catalog.add(key, data)
+    process_later(key, path, data)
+
+
+def process_later(key, path, data):
+    """Queue whatever a cached track still needs: loudness analysis, Opus conversion."""
+    analyze = settings.LOUDNESS_NORMALIZE and data.get('gain_db') is None
+    convert = settings.OPUS_CACHE and not path.endswith('.opus')
+    if (analyze or convert) and key not in transcoding:
+        transcoding.add(key)
+        transcoder.submit(process_download, key, path, data)
+
+
+def finish_tee(key, data, slot, download):
+    """Cache a download that was played while downloading (runs on its thread)."""
+    download_seconds.observe(download.elapsed, method='tee')
+    try:
+        if download.error is not None:
+            print(f'Could not download {data.get("webpage_url")}: {download.error}')
+        else:
+            # Cached before it stops being found here, so it is always one or the other
+            store_download(download.path, data)
+    finally:
+        downloading.pop(key, None)
+        slot.release()
+
+
+def process_download(key, path, data):
+    """
+    Measure a cached track's loudness and replace it with an Opus copy that
+    has the gain baked in (runs on the transcoder).
+    """
+    try:
+        data = dict(data)
+        baked = data.get('baked_gain_db') or 0.0
+        convert = settings.OPUS_CACHE and not path.endswith('.opus')
+        # Entries measured before peaks were kept need their peak before it's baked in
+        if settings.LOUDNESS_NORMALIZE and (data.get('gain_db') is None or
+                                            convert and data.get('peak_db') is None):
+            lufs, peak = loudness.measure(path)
+            if path.endswith('.opus'):
+                # Undo what conversion did to it, to get the track's own levels
+                offset = 20 * math.log10(DEFAULT_VOLUME) + baked
+                lufs, peak = (None if db is None else db - offset for db in (lufs, peak))
+            # Held down so that baked in at the default volume, peaks don't clip
+            data['gain_db'] = loudness.gain_db(lufs, settings.LOUDNESS_TARGET,
+                                               settings.LOUDNESS_MAX_BOOST, peak, DEFAULT_VOLUME)
+            data['peak_db'] = peak
+        
+        if convert:
+            baked = (data.get('gain_db') or 0.0) if settings.LOUDNESS_NORMALIZE else 0.0
+            target = opus.transcode(path, volume=DEFAULT_VOLUME * loudness.ratio(baked),
+                                    bitrate=settings.OPUS_BITRATE)
+            data['baked_gain_db'] = baked
+            cache.put(key, target, data)
+            if os.path.exists(path):
+                # Another shard sharing the cache may have got there first
+                os.remove(path)
+        else:
+            cache.put(key, path, data)
+    except Exception as e:
+        print(f'Could not process {path}: {e}')
+    finally:
+        transcoding.discard(key)
+
+
+def discard_task(task):
+    """Cancel a task that opens a source, or clean up the source if it already did."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        # Tracks that weren't opened (not downloading, or at a cap) are plain entries
+        source = task.result()
+        if isinstance(source, YTDLSource):
+            source.cleanup()
+
+
+def track_key(item):
+    """The cache key of a queued source or lazy entry."""
+    if isinstance(item, YTDLSource):
+        return item.key
+    return DownloadCache.key(item['extractor'], item['id'])
 
 
 class VoiceConnectionError(commands.CommandError):
@@ -37,11 +249,77 @@ class NotInVoiceChannel(VoiceConnectionError):
     """Exception for cases of invalid Voice Channels."""
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
+def queued_embed(sources):
+    """The message for one or more tracks added to a queue."""
+    if len(sources) == 1:
+        source = sources[0]
+        embed = discord.Embed(
+            title=f"Added to the queue!",
+            description=f"[{source['alt_title']} - {source['creator']}]({source['url']})",
+            color=0x1ABC9C
+        )
+        embed.set_thumbnail(url=source["thumbnail"])
+        return embed
+    lines = [f"[{source['alt_title']} - {source['creator']}]({source['url']})"
+             for source in sources[:10]]
+    if len(sources) > 10:
+        lines.append(f'...and {len(sources) - 10} more')
+    return discord.Embed(title=f"Added {len(sources)} songs to the queue!",
+                         description="\n".join(lines), color=0x1ABC9C)
+
+
+def now_playing_embed(source):
+    embed = discord.Embed(title="Now Playing", description=source.alt_title, color=0x1ABC9C)
+    embed.add_field(name="Requested By", value=source.requester)
+    embed.set_thumbnail(url=source.thumbnail)
+    return embed
+
+
+def running_decoders():
+    """How many FFmpeg processes are decoding for playback, shared ones once."""
+    originals = [source.original for source in list(YTDLSource.live)]
+    originals += [decode.source for decode in list(shared.decodes.values())]
+    count = 0
+    for original in originals:
+        process = getattr(original, '_process', None)
+        if process is not None and process.poll() is None:
+            count += 1
+    return count
+
+
+class YTDLSource(discord.AudioSource):
+    """
+    A track with its metadata, played at an adjustable volume.
+
+    The volume and the track's loudness correction are applied by FFmpeg,
+    so changing the volume reopens the track at the new gain from the
+    current position. Tracks in the Opus cache have both baked in at the
+    default volume, and are passed through to Discord untouched while it
+    applies. Only a track that is still downloading (which can't be
+    reopened) is scaled frame by frame. Guilds playing the same track at
+    the same volume share one decode (see :mod:`fanout`).
+    """
     
-    def __init__(self, source, *, data, requester):
-        super().__init__(source)
+    # Every source not yet garbage collected, for counting decoders
+    live = weakref.WeakSet()
+    
+    def __init__(self, source, *, data, requester, volume=1.0):
+        self.original = source
+        self._volume = volume
+        self._lock = threading.Lock()
+        # opener(volume, start) opens the track at a volume, ``start`` seconds in
+        self.opener = None
+        self.frames = 0
+        # Called (from the audio thread) when the first frame is read
+        self.on_start = None
+        # The governor's decoder slot this source holds, if any
+        self.slot = None
+        self.live.add(self)
+        
         self.requester = requester
+        self.key = DownloadCache.key(data.get('extractor'), data.get('id'))
+        self.expires = None
+        self.data = {k: data.get(k) for k in METADATA_KEYS}
         
         self.title = data.get('title')
         self.url = data.get('webpage_url')
@@ -52,6 +330,105 @@ class YTDLSource(discord.PCMVolumeTransformer):
         if not data.get('creator'):
             self.creator = data.get('uploader')
         self.thumbnail = data.get('thumbnail')
+        
+        self.set_gain(data)
+    
+    def set_gain(self, data):
+        """Take the loudness correction from a track's (cache) metadata."""
+        # The loudness correction still to apply on top of what the file has
+        gain = (data.get('gain_db') or 0.0) if settings.LOUDNESS_NORMALIZE else 0.0
+        self.baked_db = data.get('baked_gain_db') or 0.0
+        self.gain_db = gain - self.baked_db
+    
+    @property
+    def volume(self):
+        """The volume as a floating point percentage (e.g. 1.0 for 100%)."""
+        return self._volume
+    
+    @volume.setter
+    def volume(self, value):
+        value = max(value, 0.0)
+        if self.opener is not None and value != self._volume:
+            with self._lock:
+                old = self.original
+                self.original = self.opener(value, self.position)
+            old.cleanup()
+        self._volume = value
+    
+    def open(self, opener, start=0):
+        """Start playing through ``opener`` at the current volume, ``start`` seconds in."""
+        self.opener = opener
+        self.original = opener(self._volume, start)
+        self.frames = int(start / opus.FRAME_DURATION)
+        return self
+    
+    def open_file(self, path, volume, start):
+        """Open a cached file, or the Opus copy it has been replaced with since."""
+        if not os.path.exists(path):
+            hit = cache.get(self.key)
+            if hit is not None:
+                path = hit[0]
+                self.set_gain(hit[1])
+        if path.endswith('.opus'):
+            return self.open_opus(path, volume, start)
+        return self.open_ffmpeg(path, '', volume, start)
+    
+    def open_opus(self, path, volume, start):
+        level = volume / DEFAULT_VOLUME * loudness.ratio(self.gain_db)
+        if abs(level - 1) < 1e-3:
+            return opus.OpusFile(path, skip=int(start / opus.FRAME_DURATION))
+        return self.open_shared(path, '', volume, level, start)
+    
+    def open_ffmpeg(self, location, before_options, volume, start):
+        level = volume * loudness.ratio(self.gain_db)
+        if settings.SHARED_DECODE:
+            return self.open_shared(location, before_options, volume, level, start)
+        # FFmpegPCMAudio leaves FFmpeg's stdin open unless it pipes the input
+        before_options = f'-nostdin {before_options}'
+        if start:
+            before_options += f' -ss {start:.2f}'
+        return discord.FFmpegPCMAudio(location, before_options=before_options,
+                                      options=f'-vn -af volume={level:.4f}')
+    
+    def open_shared(self, location, before_options, volume, level, start):
+        """
+        Join (or start) the Opus decode of this track that every guild playing
+        it at the same volume reads from, each at its own position.
+        """
+        def decode(position):
+            return opus.FFmpegOpusAudio(location, volume=level,
+                                        start=position * opus.FRAME_DURATION,
+                                        bitrate=settings.OPUS_BITRATE,
+                                        before_options=before_options)
+        
+        # Keyed by what comes out, whichever file or stream it is decoded from
+        track = self.key if self.data.get('id') else location
+        output = round(volume * loudness.ratio(self.gain_db + self.baked_db), 4)
+        return shared.open((track, output), int(start / opus.FRAME_DURATION), decode)
+    
+    def is_opus(self):
+        return self.original.is_opus()
+    
+    def read(self):
+        with self._lock:
+            ret = self.original.read()
+        if self.on_start is not None:
+            on_start, self.on_start = self.on_start, None
+            on_start()
+        self.frames += 1
+        if self.opener is not None:
+            return ret
+        return audioop.mul(ret, 2, min(self._volume * loudness.ratio(self.gain_db), 2.0))
+    
+    @property
+    def position(self):
+        """Seconds played so far."""
+        return self.frames * opus.FRAME_DURATION
+    
+    def cleanup(self):
+        self.original.cleanup()
+        if self.slot is not None:
+            self.slot.release()
     
     def __getitem__(self, item: str):
         """
@@ -61,49 +438,202 @@ class YTDLSource(discord.PCMVolumeTransformer):
         """
         return self.__getattribute__(item)
     
+    def to_entry(self):
+        """The lazy entry for this track, to store or queue it without the source."""
+        return self.make_entry(self.data, getattr(self.requester, 'name', self.requester))
+    
+    @classmethod
+    def on_slot(cls, guild_id, build, *, force=False):
+        """
+        Build a source on one of the governor's decoder slots for the guild,
+        or return None if it can't spare one (unless ``force``).
+        """
+        slot = governor.decoders.claim(guild_id, force=force)
+        if slot is None:
+            return None
+        try:
+            source = build()
+        except BaseException:
+            slot.release()
+            raise
+        source.slot = slot
+        return source
+    
+    @classmethod
+    def from_file(cls, path, *, data, requester, start=0, volume=DEFAULT_VOLUME):
+        """Build a source for a file that is already on disk, ``start`` seconds in."""
+        if not os.path.exists(path):
+            # It may have been converted to Opus since we looked it up
+            hit = cache.get(DownloadCache.key(data.get('extractor'), data.get('id')))
+            if hit is not None:
+                path, data = hit
+        
+        # Older cache entries are measured in the background the first time
+        process_later(DownloadCache.key(data.get('extractor'), data.get('id')), path, data)
+        
+        source = cls(None, data=data, requester=requester, volume=volume)
+        # Reopened on volume changes, by which time the file may have been converted
+        return source.open(partial(source.open_file, path), start)
+    
+    @classmethod
+    def from_stream(cls, url, *, data, requester, start=0, volume=DEFAULT_VOLUME):
+        """Build a source that streams from a resolved media URL, ``start`` seconds in."""
+        # Let FFmpeg reconnect, since a prefetched stream can sit idle for a whole song
+        before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+        source = cls(None, data=data, requester=requester, volume=volume)
+        source.expires = stream_expiry(url)
+        return source.open(partial(source.open_ffmpeg, url, before_options), start)
+    
+    @classmethod
+    def from_tee(cls, path, *, data, requester, slot):
+        """
+        Build a source that plays a track while it downloads to ``path``,
+        holding the download ``slot`` until the download is done.
+        """
+        key = DownloadCache.key(data['extractor'], data['id'])
+        download = downloading.get(key)
+        if download is None:
+            hit = cache.get(key)
+            if hit is not None:
+                # Finished downloading while we were locating it
+                slot.release()
+                path, data = hit
+                return cls.from_file(path, data=data, requester=requester)
+            try:
+                download = downloading[key] = tee.TeeDownload(
+                    data['url'], path, headers=data.get('http_headers'),
+                    callback=partial(finish_tee, key, data, slot)).start()
+            except BaseException:
+                downloading.pop(key, None)
+                slot.release()
+                raise
+        else:
+            # Someone else's download is already on it
+            slot.release()
+        
+        reader = download.open_reader()
+        try:
+            source = cls(discord.FFmpegPCMAudio(reader, pipe=True, options='-vn'),
+                         data=data, requester=requester)
+        finally:
+            # FFmpeg has its own copy; ours would keep the pipe open after it exits
+            reader.close()
+        return source
+    
+    def expired(self, margin=30):
+        """Whether this is a stream whose URL has (nearly) expired."""
+        return self.expires is not None and self.expires - time.time() < margin
+    
+    @staticmethod
+    def make_entry(data, requester, *, stream=False):
+        """
+        The lightweight metadata we queue instead of a source when not
+        downloading; ``stream`` marks it to be streamed even in download mode.
+        """
+        entry = {
+            "id": data["id"], "extractor": data["extractor"],
+            "title": data["title"], "alt_title": data.get("alt_title") or data["title"],
+            "uploader": data.get("uploader"),
+            "creator": data.get("creator") or data.get("uploader"),
+            "duration": data.get("duration"), "thumbnail": data.get("thumbnail"),
+            "url": data["webpage_url"], "webpage_url": data["webpage_url"],
+            "requester": requester
+        }
+        if stream:
+            entry["stream"] = True
+        return entry
+    
     @classmethod
     async def create_source(cls, ctx, search: str, *, loop, download = False):
-        loop = loop or asyncio.get_event_loop()
+        guild_id = ctx.guild.id
+        # A search or URL we resolved recently tells us the video without asking YouTube
+        known = queries.get(search)
+        key = cache_key(search)
+        if key is None and known is not None:
+            key = DownloadCache.key(known['extractor'], known['id'])
+        local = None
+        if key is None and settings.LOCAL_SEARCH and '://' not in search:
+            # Words that surely mean a track we have don't need a YouTube search
+            key = local = catalog.resolve(search, settings.LOCAL_SEARCH_CONFIDENCE)
         
-        to_run = partial(ytdl.extract_info, url=search, download=download)
-        data = await loop.run_in_executor(None, to_run)
+        hit = cache.get(key) if key else None
+        if hit is None and local is not None:
+            # Evicted (by another shard, say) since it was indexed
+            catalog.remove([local])
+        if hit is not None:
+            path, data = hit
+            if download:
+                source = cls.on_slot(guild_id, partial(cls.from_file, path, data=data,
+                                                       requester=ctx.author))
+                if source is not None:
+                    return source
+            # Queued unopened, to be opened when it comes up
+            return cls.make_entry(data, ctx.author.name)
         
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+        stream = download and not governor.cache_bytes.allows(guild_id)
+        if stream:
+            # The guild has its share of the cache queued already
+            download = False
+        if known is not None and not download:
+            return cls.make_entry(known, ctx.author.name, stream=stream)
         
+        # Skip the search if we already know where it leads
+        target = known['webpage_url'] if known else search
+        if download and settings.TEE_DOWNLOADS:
+            # Start playing from the stream while it downloads into the cache
+            path, data = await ytdl.run(guild_id, extractor.locate, target)
+            queries.put(search, data)
+            if data.get('protocol') in ('http', 'https') and governor.decoders.room(guild_id):
+                slot = await governor.downloads.acquire(guild_id)
+                source = cls.on_slot(guild_id, partial(cls.from_tee, path, data=data,
+                                                       requester=ctx.author, slot=slot))
+                if source is not None:
+                    return source
+                slot.release()
+            # Fragmented streams need youtube_dl to put them together
+            target = data['webpage_url']
         if download:
-            source = ytdl.prepare_filename(data)
+            async with governor.downloads.hold(guild_id):
+                source, data = await ytdl.run(guild_id, extractor.download, target)
+            store_download(source, data)
         else:
-            return {
-                "title": data["title"], "url": data["url"], "alt_title":
-                    data["alt_title"],
-                "uploader": data["uploader"], "creator": data["creator"],
-                "duration": data["duration"],
-                "view_count": data["view_count"], "like_count": data["like_count"],
-                "dislike_count": data["dislike_count"],
-                "thumbnail": data["thumbnail"], "webpage_url": data["webpage_url"],
-                "requester": ctx.author.name
-            }
-        
-        return cls(discord.FFmpegPCMAudio(source, before_options='-nostdin', options='-vn'),
-                   data=data, requester=ctx.author)
+            data = await ytdl.run(guild_id, extractor.info, target)
+            remember_stream(data)
+        queries.put(search, data)
+        
+        if download:
+            opened = cls.on_slot(guild_id, partial(cls.from_file, source, data=data,
+                                                   requester=ctx.author))
+            if opened is not None:
+                return opened
+        return cls.make_entry(data, ctx.author.name, stream=stream)
     
     @classmethod
-    async def regather_stream(cls, data, *, loop):
+    async def prepare(cls, entry, *, loop, download, guild_id=None):
         """
-        Used for preparing a stream, instead of downloading.
+        Resolve a queued entry ahead of playing it, without opening it yet.
 
-        Since Youtube Streaming links expire.
+        Returns ``(location, data)`` where location is either a downloaded
+        file or a stream URL, depending on ``download``.
         """
-        loop = loop or asyncio.get_event_loop()
-        requester = data['requester']
+        if not download:
+            # Only reuse a stream URL that will last until the track has played
+            margin = (entry.get('duration') or 0) + 60
+            hit = streams.get(DownloadCache.key(entry['extractor'], entry['id']), margin)
+            if hit is not None:
+                return hit
+            data = await ytdl.run(guild_id, extractor.info, entry['webpage_url'])
+            remember_stream(data)
+            return data['url'], data
         
-        to_run = partial(ytdl.extract_info, url=data['webpage_url'], download=False)
-        data = await loop.run_in_executor(None, to_run)
+        hit = cache.get(DownloadCache.key(entry['extractor'], entry['id']))
+        if hit is not None:
+            return hit
         
-        return cls(discord.FFmpegPCMAudio(data['url'], before_options='-nostdin', options='-vn'),
-                   data=data, requester=requester)
+        async with governor.downloads.hold(guild_id):
+            path, data = await ytdl.run(guild_id, extractor.download, entry['webpage_url'])
+        store_download(path, data)
+        return path, data
 
 
 class MusicPlayer:
@@ -115,98 +645,378 @@ class MusicPlayer:
     simultaneously.
 
     When the bot disconnects from the Voice it's instance will be destroyed.
+    Disconnecting when the channel empties or the queue runs dry is up to
+    the cog, which watches voice state updates and keeps the idle timers.
     """
     
     __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current',
-                 'np', 'volume', 'repeat', 'repeating')
+                 'volume', 'repeat', 'repeating', 'fetch_slots', 'ingest_tasks',
+                 'pending', 'prefetched', 'task', 'rows', 'queued_at', 'requested_at',
+                 'ended_at')
     
-    def __init__(self, ctx):
-        self.bot = ctx.bot
-        self._guild = ctx.guild
-        self._channel = ctx.channel
-        self._cog = ctx.cog
+    def __init__(self, bot, guild, channel, cog):
+        self.bot = bot
+        self._guild = guild
+        self._channel = channel
+        self._cog = cog
         
-        self.queue = asyncio.Queue()
+        self.queue = TrackQueue()
         self.next = asyncio.Event()
         
-        self.np = None  # Now playing message
-        self.volume = .5
+        self.volume = DEFAULT_VOLUME
         self.current = None
         self.repeat = False
         self.repeating = None
         
-        ctx.bot.loop.create_task(self.player_loop())
+        # Limits how many of this guild's playlist tracks download at once
+        self.fetch_slots = asyncio.Semaphore(settings.GUILD_FETCH_CONCURRENCY)
+        self.ingest_tasks = set()
+        # Queue entries being resolved ahead of the cursor, by id()
+        self.pending = {}
+        # (id() of the next entry, task opening its source) while it is prefetched
+        self.prefetched = None
+        # Queue store row ids of the queued items, by id()
+        self.rows = {}
+        # perf_counter() times for the metrics: when each item was queued (by
+        # id()), when a play command found nothing playing, and when the last
+        # track ended with another one ready
+        self.queued_at = {}
+        self.requested_at = None
+        self.ended_at = None
+        
+        self.task = bot.loop.create_task(self.player_loop())
     
     async def player_loop(self):
         """Our main player loop."""
+        # This task's own context, so the watchdog blames the player, not the command
+        watchdog.current.set(('player_loop', self._guild.id))
         await self.bot.wait_until_ready()
         
         while not self.bot.is_closed():
-            vc = self._guild.voice_client
-            if len(vc.channel.members) == 1:
-                embed = discord.Embed(
-                    description="There are no users in the voice channel! Disconnecting...",
-                    color=0x1ABC9C
-                )
-                await self._channel.send(embed=embed)
-                self.destroy(self._guild)
             self.next.clear()
             
-            try:
-                # Wait for the next song. If we timeout cancel the player and disconnect...
-                async with timeout(300):  # 5 minutes...
-                    if self.repeat and self.current is not None:
-                        source = self.repeating
-                    else:
-                        source = await self.queue.get()
-                        self.repeating = source
-            except asyncio.TimeoutError:
-                return self.destroy(self._guild)
+            # The stored queue row of the next track, removed once it is current
+            row = None
+            if self.repeat and self.current is not None:
+                source = self.repeating
+            else:
+                if self.queue.empty():
+                    # Wait for the next song. If nothing comes, disconnect...
+                    self._cog.idle.schedule(self._guild.id, settings.IDLE_TIMEOUT,
+                                            partial(self.destroy, self._guild))
+                source = await self.queue.get()
+                self._cog.idle.cancel(self._guild.id)
+                # Kept as an entry, to open afresh for each repeat; the source
+                # itself is cleaned up once it has played
+                self.repeating = source.to_entry() if isinstance(source, YTDLSource) else source
+                row = self.rows.pop(id(source), None)
+                queued = self.queued_at.pop(id(source), None)
+                if queued is not None:
+                    queue_wait_seconds.observe(time.perf_counter() - queued)
+            
+            self.resolve_ahead()
             
             if not isinstance(source, YTDLSource):
-                # Source was probably a stream (not downloaded)
-                # So we should regather to prevent stream expiration
+                # Source is a lazy entry, so download or regather it now
+                # (unless that was already started ahead of time)
                 try:
-                    source = await YTDLSource.regather_stream(source, loop=self.bot.loop)
+                    source = await self.take_prefetched(source)
                 except Exception as e:
-                    await self._channel.send(f'There was an error processing your song.\n'
-                                             f'```css\n[{e}]\n```')
+                    self._cog.messages.send(self._channel,
+                                            f'There was an error processing your song.\n'
+                                            f'```css\n[{e}]\n```')
+                    if row is not None:
+                        queues.remove(row)
                     continue
             
             source.volume = self.volume
             self.current = source
+            cache.touch(source.key)
+            if row is not None:
+                # Saved as the current track from here on
+                queues.remove(row)
+            self.save_state()
             
+            source.on_start = self.audio_started
             self._guild.voice_client.play(source,
                                           after=lambda _: self.bot.loop.call_soon_threadsafe(
                                               self.next.set))
-            embed = discord.Embed(title="Now Playing", description=source.alt_title,
-                                  color=0x1ABC9C)
-            embed.add_field(name="Requested By", value=source.requester)
-            embed.set_thumbnail(url=vc.source.thumbnail)
-            self.np = await self._channel.send(embed=embed)
+            self.prefetch_next()
+            # One now playing message, edited for each track
+            self._cog.messages.show(self._channel, 'np', now_playing_embed(source))
             await self.next.wait()
+            # A vote to skip this track is moot now
+            self._cog.votes.cancel(self._guild.id)
+            if self.repeat or not self.queue.empty():
+                self.ended_at = time.perf_counter()
+            else:
+                # We are no longer playing anything...
+                self._cog.messages.clear(self._channel, 'np')
             
             # Make sure the FFmpeg process is cleaned up.
             source.cleanup()
-            
-            try:
-                # We are no longer playing this song...
-                await self.np.delete()
-            except discord.HTTPException:
-                pass
+    
+    def audio_started(self):
+        """Record how long the track took to be heard (runs on the audio thread)."""
+        now = time.perf_counter()
+        requested, self.requested_at = self.requested_at, None
+        if requested is not None:
+            first_audio_seconds.observe(now - requested)
+        ended, self.ended_at = self.ended_at, None
+        if ended is not None:
+            track_gap_seconds.observe(now - ended)
+    
+    def enqueue(self, item, *, front=False):
+        """Queue a source or lazy entry, and record it in the queue store."""
+        entry = item.to_entry() if isinstance(item, YTDLSource) else item
+        self.queued_at[id(item)] = time.perf_counter()
+        if front:
+            self.queue.insert(0, item)
+            self.rows[id(item)] = queues.insert(self._guild.id, entry, self.row_from(1))
+        else:
+            self.rows[id(item)] = queues.append(self._guild.id, entry)
+            self.queue.put_nowait(item)
+        self.refresh_ahead()
+    
+    def row_from(self, index):
+        """The store row of the first stored item from ``index`` on, or None past the end."""
+        for item in self.queue.slice(index, len(self.queue)):
+            row = self.rows.get(id(item))
+            if row is not None:
+                return row
+        return None
+    
+    def forget(self, item):
+        """Drop everything kept for an item taken out of the queue."""
+        row = self.rows.pop(id(item), None)
+        if row is not None:
+            queues.remove(row)
+        self.queued_at.pop(id(item), None)
+        task = self.pending.pop(id(item), None)
+        if task is not None:
+            task.cancel()
+        if self.prefetched is not None and self.prefetched[0] == id(item):
+            discard_task(self.prefetched[1])
+            self.prefetched = None
+        if isinstance(item, YTDLSource):
+            item.cleanup()
+    
+    def remove(self, index):
+        """Take the song at ``index`` out of the queue."""
+        item = self.queue.pop(index)
+        self.forget(item)
+        self.refresh_ahead()
+        return item
+    
+    def move(self, source, destination):
+        """Move the song at ``source`` to ``destination``."""
+        item = self.queue.move(source, destination)
+        row = self.rows.get(id(item))
+        if row is not None:
+            queues.move(self._guild.id, row, self.row_from(destination + 1))
+        self.refresh_ahead()
+        return item
+    
+    def shuffle(self):
+        self.queue.shuffle()
+        queues.reorder(self._guild.id, [self.rows[id(item)] for item in self.queue
+                                        if id(item) in self.rows])
+        self.refresh_ahead()
+    
+    def dedupe(self):
+        """Remove repeats of songs already queued earlier, returning how many went."""
+        dropped = self.queue.dedupe(track_key)
+        for item in dropped:
+            self.forget(item)
+        self.refresh_ahead()
+        return len(dropped)
+    
+    def refresh_ahead(self):
+        """Resolve ahead again after the front of the queue may have changed."""
+        if self.prefetched is not None and (self.queue.empty()
+                                            or id(self.queue[0]) != self.prefetched[0]):
+            discard_task(self.prefetched[1])
+            self.prefetched = None
+        self.resolve_ahead()
+    
+    def state(self):
+        """What is playing and how, for the queue store, or None when not connected."""
+        vc = self._guild.voice_client
+        if vc is None:
+            return None
+        current = self.current
+        return {'voice_channel': vc.channel.id, 'text_channel': self._channel.id,
+                'current': current.to_entry() if current else None,
+                'position': current.position if current else 0,
+                'repeat': self.repeat, 'volume': self.volume}
+    
+    def save_state(self):
+        """Record what is playing and how, so it can be picked up after a restart."""
+        state = self.state()
+        if state is not None:
+            queues.save_player(self._guild.id, **state)
+    
+    def downloads(self, entry):
+        """
+        Whether to download a lazy entry rather than stream it. This is decided
+        once per entry: a track that is cached plays from its file in any mode,
+        and past the guild's share of the cache, other tracks stream.
+        """
+        if 'stream' not in entry:
+            entry['stream'] = cache.get(track_key(entry)) is None and (
+                settings.QUEUE_MODE == 'stream' or
+                not governor.cache_bytes.allows(self._guild.id))
+        return not entry['stream']
+    
+    def resolve_ahead(self):
+        """Start resolving the next few lazy entries in the queue."""
+        for entry in self.queue.slice(0, settings.RESOLVE_AHEAD):
+            if isinstance(entry, YTDLSource) or id(entry) in self.pending:
+                continue
+            self.pending[id(entry)] = self.bot.loop.create_task(
+                YTDLSource.prepare(entry, loop=self.bot.loop, download=self.downloads(entry),
+                                   guild_id=self._guild.id))
+        self.prefetch_next()
+    
+    def prefetch_next(self):
+        """
+        Open the next lazy entry in the background.
+
+        This resolves its stream and starts its FFmpeg process while the
+        current track plays, so the next one can start without a gap.
+        """
+        if self.prefetched is not None or self.queue.empty():
+            return
+        entry = self.queue[0]
+        if isinstance(entry, YTDLSource):
+            return
+        slot = governor.decoders.claim(self._guild.id)
+        if slot is None:
+            # Nothing to spare, so the next track is opened when it comes up
+            return
+        
+        def release(task):
+            # The source holds on to the slot, unless there won't be one
+            if task.cancelled() or task.exception() is not None:
+                slot.release()
+        
+        task = self.bot.loop.create_task(self.open_entry(entry, slot))
+        task.add_done_callback(release)
+        self.prefetched = (id(entry), task)
+    
+    async def take_prefetched(self, entry):
+        """Use the prefetched source for this entry if it's still good, else open it now."""
+        prefetched, self.prefetched = self.prefetched, None
+        if prefetched is not None:
+            entry_id, task = prefetched
+            if entry_id != id(entry):
+                discard_task(task)
+            else:
+                try:
+                    source = await task
+                except Exception:
+                    pass
+                else:
+                    if not source.expired():
+                        return source
+                    # The signed URL ran out while we waited, so resolve it again.
+                    source.cleanup()
+        
+        return await self.open_entry(entry)
+    
+    async def open_entry(self, entry, slot=None):
+        """
+        Turn a lazy entry into a playable source, on the given decoder slot or
+        else one claimed whether or not the governor can spare it, since the
+        track is up next.
+        """
+        download = self.downloads(entry)
+        task = self.pending.pop(id(entry), None)
+        if task is None:
+            task = YTDLSource.prepare(entry, loop=self.bot.loop, download=download,
+                                      guild_id=self._guild.id)
+        location, data = await task
+        
+        # Entries restored mid-track resume where they left off, but only once
+        start = entry.pop('start', 0)
+        # Opened at the player's volume so starting it doesn't mean reopening it
+        if download:
+            build = partial(YTDLSource.from_file, location, data=data,
+                            requester=entry['requester'], start=start, volume=self.volume)
+        else:
+            build = partial(YTDLSource.from_stream, location, data=data,
+                            requester=entry['requester'], start=start, volume=self.volume)
+        if slot is None:
+            return YTDLSource.on_slot(self._guild.id, build, force=True)
+        source = build()
+        source.slot = slot
+        return source
     
     def destroy(self, guild):
         """Disconnect and cleanup the player."""
         return self.bot.loop.create_task(self._cog.cleanup(guild))
+    
+    def close(self):
+        """Stop the player loop and anything still being queued or resolved."""
+        self.task.cancel()
+        # Make sure the FFmpeg processes are cleaned up and decoder slots given back
+        # (cleaning up a source twice does nothing)
+        for source in (self.current, *self.queue):
+            if isinstance(source, YTDLSource):
+                source.cleanup()
+        for task in self.ingest_tasks:
+            task.cancel()
+        for task in self.pending.values():
+            task.cancel()
+        if self.prefetched is not None:
+            discard_task(self.prefetched[1])
+            self.prefetched = None
+        self._cog.messages.clear(self._channel, 'np')
 
 
 class Music(commands.Cog):
     """Provides Music Playback Functionality. User must be in a voice channel."""
     
     def __init__(self, bot):
+        phases.mark('modules')
         self.bot = bot
         self.players = {}
         self.name = "Music"
+        # Limits playlist downloads across every guild
+        self.fetch_slots = asyncio.Semaphore(settings.FETCH_CONCURRENCY)
+        # Disconnect timers for players with nothing left to play, by guild id
+        self.idle = TimerWheel(bot.loop)
+        # Skip votes in progress; their deadlines share the idle timers' wheel
+        self.votes = VoteBook(self.idle)
+        self.restored = False
+        bot.loop.create_task(self.save_loop())
+        bot.loop.create_task(self.index_catalog())
+        if settings.SNAPSHOT_INTERVAL:
+            with phases.phase('snapshot'):
+                startup.load_snapshot(self.snapshot_path(), warm)
+            bot.loop.create_task(self.snapshot_loop())
+        # Everything the players say goes out through here
+        self.messages = messaging.Messenger(bot.loop)
+        governor.queue.read = lambda: {guild_id: len(player.queue)
+                                       for guild_id, player in self.players.items()}
+        governor.cache_bytes.read = self.queued_bytes
+        
+        self.watchdog = None
+        if settings.WATCHDOG:
+            self.watchdog = watchdog.Watchdog(bot.loop,
+                                              threshold=settings.WATCHDOG_THRESHOLD_MS / 1000,
+                                              lag=loop_lag_seconds, blocked=blocked_seconds)
+            self.watchdog.start()
+        
+        self.add_gauges()
+        self.metrics_server = None
+        if settings.METRICS_PORT:
+            bot.loop.create_task(self.serve_metrics())
+        self.metrics_log = None
+        if settings.METRICS_LOG_INTERVAL:
+            self.metrics_log = bot.loop.create_task(
+                registry.log_loop(settings.METRICS_LOG_INTERVAL))
+        phases.mark('cog')
     
     async def cog_check(self, ctx):
         if not ctx.author.voice:
@@ -225,59 +1035,375 @@ class Music(commands.Cog):
             return False
         return True
     
+    async def cog_before_invoke(self, ctx):
+        # Lets the watchdog tell which command and guild blocked the loop
+        watchdog.current.set((ctx.command.qualified_name, ctx.guild.id if ctx.guild else None))
+    
     async def cleanup(self, guild):
-        await guild.voice_client.disconnect()
+        if guild.voice_client is not None:
+            await guild.voice_client.disconnect()
         
+        self.idle.cancel(guild.id)
+        self.votes.cancel(guild.id)
         try:
-            del self.players[guild.id]
+            player = self.players.pop(guild.id)
         except KeyError:
             pass
+        else:
+            player.close()
+        queues.clear(guild.id)
+        
+        await self.trim_cache()
+    
+    def add_gauges(self):
+        def players():
+            idle, active = self.player_counts()
+            return {'idle': idle, 'active': active}
+        
+        def depths():
+            return [len(player.queue) for player in self.players.values()] or [0]
+        
+        registry.gauge('tweedle_players', 'Music players, by state', players, label='state')
+        registry.gauge('tweedle_queued_tracks', 'Tracks queued across every guild',
+                       lambda: sum(depths()))
+        registry.gauge('tweedle_queue_depth_max', 'Tracks queued in the longest queue',
+                       lambda: max(depths()))
+        registry.gauge('tweedle_decoders', 'FFmpeg processes decoding for playback',
+                       running_decoders)
+        registry.gauge('tweedle_shared_decodes', 'Shared decodes and the players reading them',
+                       lambda: dict(zip(('decodes', 'readers'), shared.stats())), label='kind')
+        registry.counter('tweedle_cache_requests_total', 'Download cache lookups, by result',
+                         lambda: {'hit': cache.hits, 'miss': cache.misses}, label='result')
+        registry.counter('tweedle_local_search_total',
+                         'Searches looked up in the catalog, by whether it was sure',
+                         lambda: {'hit': catalog.hits, 'miss': catalog.misses}, label='result')
+        registry.counter('tweedle_query_cache_requests_total',
+                         'Search memo lookups, by result',
+                         lambda: {'hit': queries.hits, 'miss': queries.misses}, label='result')
+        registry.gauge('tweedle_extract_jobs', 'youtube_dl jobs, by state',
+                       lambda: {'pending': ytdl.pending, 'active': ytdl.active}, label='state')
+        registry.gauge('tweedle_transcodes', 'Downloads waiting for or being converted to Opus',
+                       lambda: len(transcoding))
+        registry.gauge('tweedle_tee_downloads', 'Tracks downloading while they play',
+                       lambda: len(downloading))
+        registry.gauge('tweedle_governed', 'What the governor caps, in use, by resource',
+                       lambda: {limit.name: limit.usage()[0] for limit in governor.limits()},
+                       label='resource')
+        registry.counter('tweedle_governor_refusals_total',
+                         'Times a governor cap was hit, by resource',
+                         lambda: {limit.name: limit.refused for limit in governor.limits()},
+                         label='resource')
+        registry.gauge('tweedle_startup_seconds', 'How long each step of starting up took',
+                       lambda: dict(phases.durations), label='phase')
+        if self.watchdog is not None:
+            registry.gauge('tweedle_loop_lag_last_seconds', 'The latest event loop lag sample',
+                           lambda: self.watchdog.last_lag)
+    
+    async def serve_metrics(self):
+        # Each worker process of a sharded bot takes the next port along
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        port = settings.METRICS_PORT + (shard_ids[0] if shard_ids else 0)
+        try:
+            self.metrics_server = await registry.serve(settings.METRICS_HOST, port)
+        except OSError as e:
+            print(f'Could not serve metrics on port {port}: {e}')
+    
+    def cog_unload(self):
+        if settings.SNAPSHOT_INTERVAL:
+            self.save_snapshot(startup.snapshot(warm))
+        # Put the event loop back as it was, or a reload would wrap it twice
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        # Free the port for the cog that is loaded next
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.metrics_log is not None:
+            self.metrics_log.cancel()
+    
+    def snapshot_path(self):
+        # Each worker process of a sharded bot keeps its own
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_ids:
+            return settings.SNAPSHOT_PATH
+        root, ext = os.path.splitext(settings.SNAPSHOT_PATH)
+        return f'{root}-{shard_ids[0]}{ext}'
+    
+    def save_snapshot(self, state):
+        try:
+            startup.save_snapshot(self.snapshot_path(), state)
+        except OSError as e:
+            print(f'Could not save the snapshot: {e}')
+    
+    async def snapshot_loop(self):
+        """Regularly save the in-memory caches, so a restart starts with them warm."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(settings.SNAPSHOT_INTERVAL)
+            # Taken here, since only the event loop touches the caches
+            await self.bot.loop.run_in_executor(None, self.save_snapshot,
+                                                startup.snapshot(warm))
+    
+    async def save_loop(self):
+        """Regularly record every player's position for restoring after a restart."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(settings.STATE_SAVE_INTERVAL)
+            # Taken here, but written in one go off the loop
+            taken = time.time()
+            states = [(guild_id, player.state()) for guild_id, player in self.players.items()]
+            states = [(guild_id, state) for guild_id, state in states if state is not None]
+            if states:
+                await self.bot.loop.run_in_executor(None, queues.save_players, states, taken)
+    
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.restored:
+            self.restored = True
+            phases.mark('login')
+            # youtube_dl loads in the background while the players reconnect
+            warming = self.bot.loop.create_task(self.warm_up())
+            with phases.phase('players'):
+                await self.restore_players()
+            await warming
+            print(phases.summary())
+    
+    async def warm_up(self):
+        """Import youtube_dl and ready the extractor workers, off the event loop."""
+        with phases.phase('youtube_dl'):
+            try:
+                await asyncio.gather(self.bot.loop.run_in_executor(None, extractor.load),
+                                     ytdl.warm_up())
+            except Exception as e:
+                print(f'Could not load youtube_dl: {e}')
+    
+    async def restore_players(self):
+        """Reconnect and rebuild the players that were running before a restart."""
+        slots = asyncio.Semaphore(RESTORE_CONCURRENCY)
+        
+        async def restore(state):
+            async with slots:
+                await self.restore_player(state)
+        
+        await asyncio.gather(*(restore(state) for state in queues.players()))
+    
+    async def restore_player(self, state):
+        guild = self.bot.get_guild(state['guild'])
+        if guild is None or guild.id in self.players:
+            # Not ours (e.g. another shard's guild), or already back
+            return
+        
+        channel = guild.get_channel(state['voice_channel'])
+        text_channel = guild.get_channel(state['text_channel'])
+        if channel is None or text_channel is None or all(m.bot for m in channel.members):
+            queues.clear(guild.id)
+            return
+        try:
+            await channel.connect()
+        except (asyncio.TimeoutError, discord.ClientException):
+            return
+        
+        player = MusicPlayer(self.bot, guild, text_channel, self)
+        player.volume = state['volume']
+        player.repeat = state['repeat']
+        entries = queues.entries(guild.id)
+        current = state['current']
+        if current is not None:
+            current['start'] = state['position']
+            # Stored as a queue row again until it is playing, so it isn't lost
+            # if the state is saved before then
+            row = queues.insert(guild.id, current, entries[0][0] if entries else None)
+            entries.insert(0, (row, current))
+        for row, entry in entries:
+            player.queue.put_nowait(entry)
+            player.rows[id(entry)] = row
+        player.resolve_ahead()
+        self.players[guild.id] = player
+        # Nothing is current until the loop gets to it
+        player.save_state()
+    
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Release a guild's player as soon as its voice channel empties."""
+        guild = member.guild
+        player = self.players.get(guild.id)
+        if player is None:
+            return
+        
+        vc = guild.voice_client
+        if vc is None or (member.id == self.bot.user.id and after.channel is None):
+            # We were disconnected from voice by someone else
+            return await self.cleanup(guild)
+        
+        if vc.channel not in (before.channel, after.channel):
+            return
+        if all(m.bot for m in vc.channel.members):
+            embed = discord.Embed(
+                description="There are no users in the voice channel! Disconnecting...",
+                color=0x1ABC9C
+            )
+            self.messages.send(player._channel, embed=embed)
+            await self.cleanup(guild)
+    
+    def player_counts(self):
+        """How many players are idle (waiting to time out) and how many are active."""
+        idle = sum(guild_id in self.idle for guild_id in self.players)
+        return idle, len(self.players) - idle
+    
+    def pinned_keys(self):
+        """Tracks that are queued or playing in any guild and must not be evicted."""
+        pinned = set()
+        for player in self.players.values():
+            for source in (player.current, player.repeating, *player.queue):
+                if source is not None:
+                    pinned.add(track_key(source))
+        return pinned
+    
+    def queued_bytes(self):
+        """Bytes of downloaded tracks each guild has queued or playing."""
+        keys = {}
+        for guild_id, player in self.players.items():
+            keys[guild_id] = {track_key(source) for source in (player.current, *player.queue)
+                              if source is not None}
+        sizes = cache.sizes(set().union(*keys.values()))
+        return {guild_id: sum(sizes.get(key, 0) for key in tracks)
+                for guild_id, tracks in keys.items()}
+    
+    async def trim_cache(self):
+        """Evict old downloads in the background, keeping anything still in use."""
+        pinned = self.pinned_keys()
+        # Shards sharing the cache must not evict what this one is playing
+        owner = str(getattr(self.bot, 'shard_ids', None) or self.bot.shard_id)
+        await self.bot.loop.run_in_executor(None, cache.pin, owner, pinned)
+        evicted = await self.bot.loop.run_in_executor(None, cache.evict, pinned)
+        if evicted:
+            await self.bot.loop.run_in_executor(None, catalog.remove, evicted)
+    
+    async def index_catalog(self):
+        """Index the cached tracks the catalog is missing, e.g. from before it existed."""
+        tracks = await self.bot.loop.run_in_executor(None, cache.tracks)
+        await self.bot.loop.run_in_executor(None, catalog.sync, tracks)
     
     def get_player(self, ctx):
         """Retrieve the guild player, or generate one."""
         try:
             player = self.players[ctx.guild.id]
         except KeyError:
-            player = MusicPlayer(ctx)
+            player = MusicPlayer(ctx.bot, ctx.guild, ctx.channel, ctx.cog)
             self.players[ctx.guild.id] = player
         
         return player
     
-    def gather_playlist(self, url):
-        sTUBE = ''
-        cPL = ''
-        amp = 0
-        final_url = []
-        
-        if 'list=' in url:
-            eq = url.rfind('=') + 1
-            cPL = url[eq:]
-        
-        else:
-            return [url]
+    async def gather_playlist(self, url):
+        """
+        Expand a playlist URL into the URLs of its videos, in playlist order.
+
+        youtube_dl walks the playlist a page at a time on one of the extractor
+        pool's walker threads, and each URL is yielded as soon as its page
+        arrives, so the first tracks can be queued while later pages are still
+        loading. Anything that is not a playlist is yielded as is.
+        """
+        if 'list=' not in url:
+            yield url
+            return
         
+        tracks = ytdl.walk(extractor.playlist_entries, url)
+        yielded = False
         try:
-            yTUBE = urllib.request.urlopen(url).read()
-            sTUBE = str(yTUBE)
-        except urllib.error.URLError as e:
-            print(e.reason)
+            async for track in tracks:
+                yielded = True
+                yield track
+        except Exception as e:
+            print(e)
+            if not yielded:
+                yield url
+        finally:
+            # Stops the walk if we are closed early
+            await tracks.aclose()
+    
+    def queue_full(self, ctx):
+        """Whether the guild's queue is at its cap, telling the user if it is."""
+        if governor.queue.allows(ctx.guild.id):
+            return False
+        embed = discord.Embed(
+            description="The queue is full! Let some songs play first.",
+            color=0x1ABC9C
+        )
+        self.messages.send(ctx.channel, embed=embed)
+        return True
+    
+    async def fetch_track(self, ctx, player, track):
+        async with player.fetch_slots, self.fetch_slots:
+            return await YTDLSource.create_source(ctx, track, loop=self.bot.loop,
+                                                  download=settings.QUEUE_MODE == 'download')
+    
+    async def ingest_playlist(self, ctx, player, playlist):
+        """
+        Download an (async) playlist several tracks at a time.
+
+        Tracks are still queued in playlist order, each one as soon as it and
+        everything before it is ready, so playback starts with the first track.
+        Returns how many tracks were queued.
+        """
+        fetches = asyncio.Queue()  # fetch tasks in playlist order, then None
+        started = settled = 0
         
-        tmp_mat = re.compile(r'watch\?v=\S+?list=' + cPL)
-        mat = re.findall(tmp_mat, sTUBE)
+        async def expand():
+            nonlocal started
+            try:
+                async for track in playlist:
+                    # Stop at what the queue has room for, counting tracks on their way
+                    if governor.queue.room(ctx.guild.id) <= started - settled:
+                        break
+                    started += 1
+                    fetches.put_nowait(self.bot.loop.create_task(
+                        self.fetch_track(ctx, player, track)))
+            finally:
+                fetches.put_nowait(None)
         
-        if mat:
-            
-            for PL in mat:
-                yPL = str(PL)
-                if '&' in yPL:
-                    yPL_amp = yPL.index('&')
-                final_url.append('http://www.youtube.com/' + yPL[:yPL_amp])
-            
-            all_url = list(set(final_url))
-            return all_url
+        expander = self.bot.loop.create_task(expand())
+        queued = 0
+        task = None
+        try:
+            while True:
+                task = await fetches.get()
+                if task is None:
+                    break
+                try:
+                    source = await task
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    continue
+                finally:
+                    settled += 1
+                task = None
+                if not governor.queue.allows(ctx.guild.id):
+                    # Filled up by other commands meanwhile
+                    if isinstance(source, YTDLSource):
+                        source.cleanup()
+                    break
+                player.enqueue(source)
+                queued += 1
+        finally:
+            expander.cancel()
+            # Anything downloaded but never queued must not leak its FFmpeg process.
+            if task is not None:
+                discard_task(task)
+            while not fetches.empty():
+                task = fetches.get_nowait()
+                if task is not None:
+                    discard_task(task)
         
-        else:
-            return [url]
+        await self.trim_cache()
+        return queued
+    
+    async def queue_playlist(self, ctx, player, url):
+        queued = await self.ingest_playlist(ctx, player, self.gather_playlist(url))
+        description = f"Added {queued} songs to the Queue!"
+        if not governor.queue.room(ctx.guild.id):
+            description += " The queue is full now."
+        embed = discord.Embed(description=description, color=0x1ABC9C)
+        self.messages.send(ctx.channel, embed=embed)
     
     @commands.command(aliases=["join"])
     async def summon(self, ctx):
@@ -306,6 +1432,7 @@ class Music(commands.Cog):
     
     @commands.command()
     async def play(self, ctx, *, search):
+        started = time.perf_counter()
         
         if not len(ctx.message.embeds) == 1 and "https://" in search:
             return
@@ -315,31 +1442,26 @@ class Music(commands.Cog):
         
         if ctx.author in ctx.voice_client.channel.members:
             player = self.get_player(ctx)
-            playlist = self.gather_playlist(search)
-            if len(playlist) > 1:
+            if self.queue_full(ctx):
+                return
+            if 'list=' in search:
                 embed = discord.Embed(
-                    description=f"Added {len(playlist)} songs to the Queue!",
+                    description="Adding the playlist to the Queue...",
                     color=0x1ABC9C
                 )
                 await ctx.send(embed=embed)
-                for track in playlist:
-                    try:
-                        source = await YTDLSource.create_source(ctx, track, loop=self.bot.loop,
-                                                                download=True)
-                        await player.queue.put(source)
-                    except:
-                        pass
+                task = self.bot.loop.create_task(self.queue_playlist(ctx, player, search))
+                player.ingest_tasks.add(task)
+                task.add_done_callback(player.ingest_tasks.discard)
             else:
                 source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop,
-                                                        download=True)
-                await player.queue.put(source)
-                embed = discord.Embed(
-                    title=f"Added to the queue!",
-                    description=f"[{source['alt_title']} - {source['creator']}]({source['url']})",
-                    color=0x1ABC9C
-                )
-                embed.set_thumbnail(url=source["thumbnail"])
-                await ctx.send(embed=embed)
+                                                        download=settings.QUEUE_MODE == 'download')
+                if not ctx.voice_client.is_playing():
+                    player.requested_at = started
+                player.enqueue(source)
+                # Tracks added in quick succession are announced together
+                self.messages.summarize(ctx.channel, 'queued', source, queued_embed)
+                await self.trim_cache()
     
     @commands.command(brief="Pauses the current song.")
     async def pause(self, ctx):
@@ -408,10 +1530,17 @@ class Music(commands.Cog):
             elif not vc.is_playing():
                 return
             
-            def stop():
-                vc.stop()
-            
-            if len(vc.channel.members) > 2:
+            listeners = sum(not m.bot for m in vc.channel.members)
+            if listeners > 1:
+                vote = self.votes.open(ctx.guild.id)
+                if vote is not None:
+                    embed = discord.Embed(
+                        description=f"There is already a vote to skip this song! "
+                                    f"[Vote here]({vote.message.jump_url})",
+                        color=0x1ABC9C
+                    )
+                    return await ctx.send(embed=embed, delete_after=20)
+                
                 embed = discord.Embed(
                     title="Music Player",
                     description=f"""
@@ -420,52 +1549,57 @@ class Music(commands.Cog):
                     color=0x1ABC9C
                 )
                 msg = await ctx.send(embed=embed)
-                await msg.add_reaction("✅")
-                await asyncio.sleep(1)
-                await msg.add_reaction("❎")
-                await asyncio.sleep(1)
-                pro = 0
-                against = 0
-                total = len(vc.channel.members) - 1
-                
-                def check(r, u):
-                    return u in vc.channel.members
-                
-                try:
-                    for i in range(120):
-                        reaction, user = await self.bot.wait_for("reaction_add", check=check)
-                        if pro >= total * .75:
-                            stop()
-                            break
-                        elif against >= total * .75:
-                            raise Exception
-                        elif str(reaction.emoji) == "✅":
-                            pro = pro + 1
-                        elif str(reaction.emoji) == "❎":
-                            against = against + 1
-                        await asyncio.sleep(1)
-                    emebd = discord.Embed(
-                        title="Music Player",
-                        description="A majority was reached! Skipping...",
-                        color=0x1ABC9C
-                    )
-                except Exception as e:
-                    embed = discord.Embed(
-                        description="A majority vote was not reached!",
-                        color=0x1ABC9C
-                    )
-                await msg.edit(embed=embed, delete_after=20)
+                self.votes.start(ctx.guild.id, msg, vc.source, voters=listeners,
+                                 ratio=settings.SKIP_VOTE_RATIO,
+                                 timeout=settings.SKIP_VOTE_TIMEOUT,
+                                 on_done=partial(self.vote_done, vc))
+                self.messages.react(msg, YES)
+                self.messages.react(msg, NO)
             else:
                 embed = discord.Embed(
                     description="The song has been skipped!",
                     color=0x1ABC9C
                 )
                 await ctx.send(embed=embed, delete_after=20)
-                stop()
+                vc.stop()
+    
+    def vote_done(self, vc, vote, passed):
+        if passed is None:
+            embed = discord.Embed(description="The song changed, so the vote is over.",
+                                  color=0x1ABC9C)
+        elif passed:
+            embed = discord.Embed(title="Music Player",
+                                  description="A majority was reached! Skipping...",
+                                  color=0x1ABC9C)
+            if vc.source is vote.track:
+                vc.stop()
+        else:
+            embed = discord.Embed(description="A majority vote was not reached!",
+                                  color=0x1ABC9C)
+        self.messages.edit(vote.message, embed, delete_after=20)
+    
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """Count a skip vote, if it is for one and from someone listening."""
+        vote = self.votes.get(payload.message_id)
+        if vote is None or payload.user_id == self.bot.user.id:
+            return
+        guild = self.bot.get_guild(payload.guild_id)
+        member = guild and guild.get_member(payload.user_id)
+        if member is None or member.voice is None or guild.voice_client is None or \
+                member.voice.channel != guild.voice_client.channel:
+            return
+        vote.react(payload.user_id, str(payload.emoji), True)
+    
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        vote = self.votes.get(payload.message_id)
+        if vote is not None:
+            vote.react(payload.user_id, str(payload.emoji), False)
     
     @commands.command(aliases=['q'], brief="Provides queued songs")
-    async def queue(self, ctx):
-        """Provides a list of upcoming songs!"""
+    async def queue(self, ctx, page: int = 1):
+        """Provides a list of upcoming songs, a page at a time!"""
         vc = ctx.voice_client
         
         if not vc or not vc.is_connected():
@@ -479,10 +1613,114 @@ class Music(commands.Cog):
                 embed=discord.Embed(description='There are currently no more queued songs.',
                                     color=0x1ABC9C))
         
-        text = "\n\n".join(i["alt_title"] for i in player.queue._queue)
+        # Only the songs on the requested page are looked at
+        pages = -(-len(player.queue) // QUEUE_PAGE_SIZE)
+        page = max(1, min(page, pages))
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        items = player.queue.slice(start, start + QUEUE_PAGE_SIZE)
+        text = "\n\n".join(f'`{position}.` {item["alt_title"]}'
+                            for position, item in enumerate(items, start + 1))
+        
+        embed = discord.Embed(title=f'In Queue - {len(player.queue)}', description=text,
+                              color=0x1ABC9C)
+        embed.set_footer(text=f'Page {page}/{pages}')
+        await ctx.send(embed=embed)
+    
+    async def edit_queue(self, ctx, *positions):
+        """The player, if the author may edit its queue and every position is in it."""
+        vc = ctx.voice_client
+        if vc is None or ctx.author not in vc.channel.members:
+            return None
+        player = self.get_player(ctx)
+        if not all(1 <= position <= len(player.queue) for position in positions):
+            await ctx.send(embed=discord.Embed(description="There's no song at that position!",
+                                               color=0x1ABC9C), delete_after=20)
+            return None
+        return player
+    
+    @commands.command(aliases=['rm'], brief="Removes a song from the queue.")
+    async def remove(self, ctx, position: int):
+        """Remove the song at a position in the queue."""
+        player = await self.edit_queue(ctx, position)
+        if player is None:
+            return
+        item = player.remove(position - 1)
+        await ctx.send(embed=discord.Embed(
+            description=f'Removed {item["alt_title"]} from the queue!', color=0x1ABC9C))
+    
+    @commands.command(aliases=['mv'], brief="Moves a song in the queue.")
+    async def move(self, ctx, source: int, destination: int):
+        """Move the song at one position in the queue to another."""
+        player = await self.edit_queue(ctx, source, destination)
+        if player is None:
+            return
+        item = player.move(source - 1, destination - 1)
+        await ctx.send(embed=discord.Embed(
+            description=f'Moved {item["alt_title"]} to position {destination}!', color=0x1ABC9C))
+    
+    @commands.command(brief="Shuffles the queue.")
+    async def shuffle(self, ctx):
+        """Shuffle the upcoming songs."""
+        player = await self.edit_queue(ctx)
+        if player is None:
+            return
+        player.shuffle()
+        await ctx.send(embed=discord.Embed(description=f'{ctx.author}: Shuffled the queue!',
+                                           color=0x1ABC9C))
+    
+    @commands.command(brief="Removes duplicate songs from the queue.")
+    async def dedupe(self, ctx):
+        """Remove songs that are already queued earlier on."""
+        player = await self.edit_queue(ctx)
+        if player is None:
+            return
+        removed = player.dedupe()
+        await ctx.send(embed=discord.Embed(description=f'Removed {removed} duplicate songs!',
+                                           color=0x1ABC9C))
+    
+    @commands.command(aliases=['pn'], brief="Queues a song to play next.")
+    async def playnext(self, ctx, *, search):
+        """Queue a song at the front of the queue."""
+        started = time.perf_counter()
+        if not ctx.voice_client:
+            await ctx.invoke(self.summon)
+        
+        if ctx.author in ctx.voice_client.channel.members:
+            player = self.get_player(ctx)
+            if self.queue_full(ctx):
+                return
+            source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop,
+                                                    download=settings.QUEUE_MODE == 'download')
+            if not ctx.voice_client.is_playing():
+                player.requested_at = started
+            player.enqueue(source, front=True)
+            embed = discord.Embed(
+                title=f"Playing next!",
+                description=f"[{source['alt_title']} - {source['creator']}]({source['url']})",
+                color=0x1ABC9C
+            )
+            embed.set_thumbnail(url=source["thumbnail"])
+            await ctx.send(embed=embed)
+            await self.trim_cache()
+    
+    @commands.command(brief="Searches the songs that are already downloaded.")
+    async def search(self, ctx, *, query):
+        """List the downloaded songs that best match a search, best first."""
+        hits = catalog.search(query, limit=QUEUE_PAGE_SIZE)
+        if not hits:
+            return await ctx.send(
+                embed=discord.Embed(description='No downloaded songs match that.',
+                                    color=0x1ABC9C))
         
-        await self.bot.Pager.embed_generator_send(ctx, text, lines=20,
-                                                  title=f'In Queue - {len(player.queue._queue)}')
+        text = "\n\n".join(
+            f'`{position}.` [{hit["data"]["title"]}]({hit["data"]["webpage_url"]}) '
+            f'({hit["confidence"]:.0%})'
+            for position, hit in enumerate(hits, 1))
+        embed = discord.Embed(title=f'Downloaded Songs - {len(hits)}', description=text,
+                              color=0x1ABC9C)
+        if settings.LOCAL_SEARCH and hits[0]['confidence'] >= settings.LOCAL_SEARCH_CONFIDENCE:
+            embed.set_footer(text='Playing this search would play the first one.')
+        await ctx.send(embed=embed)
     
     @commands.command(aliases=['np'], brief="Displays the current song")
     async def playing(self, ctx):
@@ -500,17 +1738,8 @@ class Music(commands.Cog):
                 embed=discord.Embed(description='I am not currently playing anything!',
                                     color=0x1ABC9C))
         
-        try:
-            # Remove our previous now_playing message.
-            await player.np.delete()
-        except discord.HTTPException:
-            pass
-        
-        embed = discord.Embed(title="Now Playing", description=vc.source.alt_title,
-                              color=0x1ABC9C)
-        embed.add_field(name="Requested By", value=vc.source.requester)
-        embed.set_thumbnail(url=vc.source.thumbnail)
-        player.np = await ctx.send(embed=embed)
+        # Move the now playing message down to the bottom of the channel
+        self.messages.show(player._channel, 'np', now_playing_embed(player.current), fresh=True)
     
     @commands.command(aliases=['vol'], brief="Changes the player volume!")
     async def volume(self, ctx, *, vol: float):
@@ -535,6 +1764,7 @@ class Music(commands.Cog):
                 vc.source.volume = vol / 100
             
             player.volume = vol / 100
+            player.save_state()
             await ctx.send(
                 embed=discord.Embed(description=f'{ctx.author}: Set the volume to {vol}%',
                                     color=0x1ABC9C))
@@ -558,6 +1788,7 @@ class Music(commands.Cog):
                 else:
                     player.repeat = True
                     out = f"The song {vc.source.title} is now on repeat!"
+                player.save_state()
             
             except AttributeError:
                 out = "There is not currently a song playing!"
@@ -581,6 +1812,75 @@ class Music(commands.Cog):
                 color=0x1ABC9C
             )
             await ctx.send(embed=embed)
+    
+    @commands.command(brief="Shows download cache statistics.")
+    @commands.is_owner()
+    async def cachestats(self, ctx):
+        """Show hit, miss and eviction counters for the download and search caches."""
+        stats = cache.stats()
+        embed = discord.Embed(title="Download Cache", color=0x1ABC9C)
+        embed.add_field(name="Tracks", value=stats['entries'])
+        embed.add_field(name="Size", value=f"{stats['bytes'] / 2 ** 20:.1f} MiB")
+        embed.add_field(name="Hits", value=stats['hits'])
+        embed.add_field(name="Misses", value=stats['misses'])
+        embed.add_field(name="Evictions", value=stats['evictions'])
+        embed.add_field(name="Evicted", value=f"{stats['evicted_bytes'] / 2 ** 20:.1f} MiB")
+        embed.add_field(name="Swept", value=f"{stats['swept_bytes'] / 2 ** 20:.1f} MiB")
+        embed.add_field(name="Search Hits", value=f"{queries.hits}/{queries.hits + queries.misses}")
+        embed.add_field(name="Stream Hits", value=f"{streams.hits}/{streams.hits + streams.misses}")
+        await ctx.send(embed=embed)
+    
+    @commands.command(brief="Shows how many players are running.")
+    @commands.is_owner()
+    async def playerstats(self, ctx):
+        """Show how many guild players are active and how many are idle."""
+        idle, active = self.player_counts()
+        embed = discord.Embed(title="Players", color=0x1ABC9C)
+        embed.add_field(name="Active", value=active)
+        embed.add_field(name="Idle", value=idle)
+        await ctx.send(embed=embed)
+    
+    @commands.command(brief="Shows what the players use against their caps.")
+    @commands.is_owner()
+    async def resources(self, ctx):
+        """Show what each capped resource has in use, its caps and how often they were hit."""
+        def amount(name, n):
+            return f'{n / 2 ** 20:.1f} MiB' if name == 'cache_bytes' else n
+        
+        def cap(name, n):
+            return amount(name, n) if n else 'no cap'
+        
+        embed = discord.Embed(title="Resources", color=0x1ABC9C)
+        for limit in governor.report():
+            name = limit['name']
+            embed.add_field(name=name.replace('_', ' ').capitalize(),
+                            value=f"{amount(name, limit['used'])} of {cap(name, limit['total'])}\n"
+                                  f"Busiest guild: {amount(name, limit['busiest'])} of "
+                                  f"{cap(name, limit['per_guild'])}\n"
+                                  f"Capped {limit['refused']}x")
+        await ctx.send(embed=embed)
+    
+    @commands.command(brief="Shows what has been blocking the event loop.")
+    @commands.is_owner()
+    async def blocking(self, ctx):
+        """Lists the commands and places that blocked the event loop the longest."""
+        if self.watchdog is None:
+            return await ctx.send(embed=discord.Embed(
+                description='The watchdog is off; set WATCHDOG=1 to turn it on.',
+                color=0x1ABC9C))
+        
+        offenders = self.watchdog.worst(10)
+        embed = discord.Embed(title="Event Loop Blockers", color=0x1ABC9C,
+                              description=f'Current lag: {self.watchdog.last_lag * 1000:.0f}ms')
+        for offender in offenders:
+            embed.add_field(name=f"{offender['command'] or '?'} (guild {offender['guild']})",
+                            value=f"`{offender['where']}`\n"
+                                  f"{offender['count']}x, {offender['total'] * 1000:.0f}ms total, "
+                                  f"worst {offender['worst'] * 1000:.0f}ms",
+                            inline=False)
+        if not offenders:
+            embed.add_field(name="Nothing yet", value="No callback has gone over the threshold.")
+        await ctx.send(embed=embed)
 
 
 def setup(bot):
@@ -0,0 +1,128 @@
+import os
+import shlex
+import struct
+import subprocess
+
+import discord
+
+# How much audio one Opus packet holds; we encode with libopus' default.
+FRAME_DURATION = 0.02
+
+
+def ogg_packets(stream):
+    """Yield the packets of an Ogg stream, reading it a page at a time."""
+    partial = b''
+    while True:
+        header = stream.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            return
+        segments = struct.unpack_from('<B', header, 26)[0]
+        table = stream.read(segments)
+        body = stream.read(sum(table))
+
+        offset = 0
+        for size in table:
+            partial += body[offset:offset + size]
+            offset += size
+            # A lacing value of 255 means the packet continues in the next segment
+            if size < 255:
+                yield partial
+                partial = b''
+
+
+def audio_packets(stream, skip=0):
+    """The Opus audio packets of an Ogg Opus stream, minus its headers."""
+    for packet in ogg_packets(stream):
+        if packet.startswith((b'OpusHead', b'OpusTags')):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        yield packet
+
+
+class OpusFile(discord.AudioSource):
+    """
+    Plays an Ogg Opus file by passing its packets straight to Discord.
+
+    Nothing is decoded or encoded along the way, so the volume is whatever
+    was baked into the file. ``skip`` starts playback that many packets in.
+    """
+
+    def __init__(self, path, *, skip=0):
+        self._file = open(path, 'rb')
+        self._packets = audio_packets(self._file, skip)
+
+    def read(self):
+        return next(self._packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class FFmpegOpusAudio(discord.AudioSource):
+    """
+    Re-encodes a file to Opus in FFmpeg, applying a gain on the way.
+
+    Used when an Opus file has to be played at a volume other than the one
+    baked into it, and for decodes shared between guilds; the scaling happens
+    in FFmpeg rather than in Python. ``path`` may also be a stream URL, with
+    ``before_options`` for its input.
+    """
+
+    def __init__(self, path, *, volume=1.0, start=0.0, bitrate='128k', before_options=''):
+        args = ['ffmpeg', '-nostdin', *shlex.split(before_options), '-ss', f'{start:.2f}',
+                '-i', path, '-vn',
+                '-af', f'volume={volume:.4f}', '-c:a', 'libopus', '-b:a', bitrate,
+                '-ar', '48000', '-ac', '2', '-f', 'ogg', '-loglevel', 'warning', 'pipe:1']
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            raise discord.ClientException('ffmpeg was not found.') from None
+        self._packets = audio_packets(self._process.stdout)
+
+    def read(self):
+        return next(self._packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        proc = self._process
+        if proc is None:
+            return
+        proc.kill()
+        if proc.poll() is None:
+            proc.communicate()
+        self._process = None
+
+
+def transcode(source, *, volume=1.0, bitrate='128k'):
+    """
+    Convert a downloaded file to Ogg Opus next to it, with a baked-in gain.
+
+    Blocks until FFmpeg is done; returns the path of the new file.
+    """
+    target = os.path.splitext(source)[0] + '.opus'
+    # Per process, as shards sharing a cache may convert the same track at once
+    partial = f'{target}.{os.getpid()}.part'
+    try:
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-i', source, '-vn',
+                        '-af', f'volume={volume:.4f}', '-c:a', 'libopus', '-b:a', bitrate,
+                        '-ar', '48000', '-ac', '2', '-f', 'ogg', '-loglevel', 'error',
+                        partial],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, check=True)
+        os.replace(partial, target)
+    except BaseException:
+        # Not in the cache index, so nothing else would ever delete it
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    return target
@@ -0,0 +1,155 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class QueueStore:
+    """
+    Keeps every guild's queue and playback state on disk.
+
+    Queued tracks are stored as the lightweight entry dicts the player
+    queues in lazy mode, one row each, ordered by a position column that is
+    indexed per guild. Positions are fractional, so inserting or moving a
+    track only rewrites its own row: it takes the midpoint between its new
+    neighbours, found through the index. Removing is by row id. All of these
+    stay cheap however long the queue gets. The player state (current track,
+    position, repeat and volume) is one row per guild; :meth:`save_players`
+    writes every guild's in one transaction.
+
+    Commits aren't synced to disk one by one (WAL with synchronous=NORMAL),
+    so writing them on the event loop stays cheap. A power cut can lose the
+    last few; a crash of the bot can't.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS queue ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, guild INTEGER NOT NULL, '
+                         'pos REAL NOT NULL, data TEXT NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS queue_guild_pos ON queue (guild, pos)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS players ('
+                         'guild INTEGER PRIMARY KEY, voice_channel INTEGER NOT NULL, '
+                         'text_channel INTEGER NOT NULL, current TEXT, '
+                         'position REAL NOT NULL, repeat INTEGER NOT NULL, '
+                         'volume REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _place(self, guild_id, before):
+        """A free position just ahead of row ``before``, or at the end when it is None."""
+        if before is None:
+            last, = self._db.execute('SELECT MAX(pos) FROM queue WHERE guild = ?',
+                                     (guild_id,)).fetchone()
+            return (last or 0) + 1
+        row = self._db.execute('SELECT pos FROM queue WHERE id = ?', (before,)).fetchone()
+        if row is None:
+            return self._place(guild_id, None)
+        pos, = row
+        prev, = self._db.execute('SELECT MAX(pos) FROM queue WHERE guild = ? AND pos < ?',
+                                 (guild_id, pos)).fetchone()
+        if prev is None:
+            return pos - 1
+        if pos - prev < 1e-9:
+            # Out of room between the two after many inserts here, so spread them out again
+            self._renumber(guild_id)
+            return self._place(guild_id, before)
+        return (prev + pos) / 2
+
+    def _renumber(self, guild_id):
+        ids = self._db.execute('SELECT id FROM queue WHERE guild = ? ORDER BY pos',
+                               (guild_id,)).fetchall()
+        self._db.executemany('UPDATE queue SET pos = ? WHERE id = ?',
+                             [(pos, row_id) for pos, (row_id,) in enumerate(ids, 1)])
+
+    def insert(self, guild_id, entry, before=None):
+        """Add an entry ahead of row ``before`` (or at the end), returning its row id."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            pos = self._place(guild_id, before)
+            cursor = self._db.execute('INSERT INTO queue (guild, pos, data) VALUES (?, ?, ?)',
+                                      (guild_id, pos, json.dumps(entry)))
+            self._db.execute('COMMIT')
+        return cursor.lastrowid
+
+    def append(self, guild_id, entry):
+        """Add an entry to the end of a guild's queue, returning its row id."""
+        return self.insert(guild_id, entry)
+
+    def move(self, guild_id, row_id, before=None):
+        """Move a row ahead of row ``before``, or to the end."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('UPDATE queue SET pos = ? WHERE id = ?',
+                             (self._place(guild_id, before), row_id))
+            self._db.execute('COMMIT')
+
+    def reorder(self, guild_id, row_ids):
+        """Store a whole new order for a guild's queue, e.g. after a shuffle."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('UPDATE queue SET pos = ? WHERE id = ? AND guild = ?',
+                                 [(pos, row_id, guild_id)
+                                  for pos, row_id in enumerate(row_ids, 1)])
+            self._db.execute('COMMIT')
+
+    def remove(self, row_id):
+        with self._lock:
+            self._db.execute('DELETE FROM queue WHERE id = ?', (row_id,))
+
+    def entries(self, guild_id):
+        """All of a guild's queue in order, as ``(row id, entry)`` pairs."""
+        with self._lock:
+            rows = self._db.execute('SELECT id, data FROM queue WHERE guild = ? ORDER BY pos',
+                                    (guild_id,)).fetchall()
+        return [(row_id, json.loads(data)) for row_id, data in rows]
+
+    def save_player(self, guild_id, **state):
+        """
+        Save a guild's player state: ``voice_channel``, ``text_channel``,
+        ``current``, ``position``, ``repeat`` and ``volume``.
+        """
+        self.save_players([(guild_id, state)])
+
+    def save_players(self, states, taken=None):
+        """
+        Save many players' states in one go, as ``(guild id, state)`` pairs.
+        ``taken`` is when they were read (now, by default); a guild whose
+        state was saved since then keeps the newer one.
+        """
+        taken = time.time() if taken is None else taken
+        rows = [(guild_id, state['voice_channel'], state['text_channel'],
+                 json.dumps(state['current']) if state['current'] else None,
+                 state['position'], int(state['repeat']), state['volume'], taken)
+                for guild_id, state in states]
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT INTO players (guild, voice_channel, text_channel, current, '
+                'position, repeat, volume, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (guild) DO UPDATE SET voice_channel = excluded.voice_channel, '
+                'text_channel = excluded.text_channel, current = excluded.current, '
+                'position = excluded.position, repeat = excluded.repeat, '
+                'volume = excluded.volume, updated = excluded.updated '
+                'WHERE excluded.updated >= players.updated', rows)
+            self._db.execute('COMMIT')
+
+    def players(self):
+        """The saved state of every guild, as dicts."""
+        with self._lock:
+            rows = self._db.execute('SELECT guild, voice_channel, text_channel, current, '
+                                    'position, repeat, volume FROM players').fetchall()
+        return [{
+            'guild': guild, 'voice_channel': voice_channel, 'text_channel': text_channel,
+            'current': json.loads(current) if current else None, 'position': position,
+            'repeat': bool(repeat), 'volume': volume
+        } for guild, voice_channel, text_channel, current, position, repeat, volume in rows]
+
+    def clear(self, guild_id):
+        """Forget a guild's queue and player state."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM queue WHERE guild = ?', (guild_id,))
+            self._db.execute('DELETE FROM players WHERE guild = ?', (guild_id,))
+            self._db.execute('COMMIT')
@@ -0,0 +1,115 @@
+import os
+from dotenv import load_dotenv
+
+# Settings are read from the environment (or .env) once at import time.
+# See .env.dist for the full list.
+
+load_dotenv()
+
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', 'downloads')
+
+# Disk budget for DOWNLOAD_DIR; 0 disables the limit.
+CACHE_MAX_BYTES = int(float(os.getenv('CACHE_MAX_MB', 2048)) * 1024 * 1024)
+CACHE_MAX_AGE = int(float(os.getenv('CACHE_MAX_AGE_DAYS', 30)) * 24 * 60 * 60)
+
+# How many playlist tracks are downloaded in parallel, per guild and overall.
+GUILD_FETCH_CONCURRENCY = int(os.getenv('GUILD_FETCH_CONCURRENCY', 3))
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 8))
+
+# How tracks are queued:
+#   download - download every track as soon as it is queued
+#   lazy     - queue metadata only and download shortly before playing
+#   stream   - queue metadata only and stream instead of downloading
+QUEUE_MODE = os.getenv('QUEUE_MODE', 'download')
+# How many queued tracks ahead of the current one are resolved in lazy/stream mode
+RESOLVE_AHEAD = int(os.getenv('RESOLVE_AHEAD', 2))
+
+# youtube_dl worker pool: number of workers, how many jobs may wait for one,
+# and whether the workers are processes rather than threads.
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 4))
+EXTRACT_MAX_PENDING = int(os.getenv('EXTRACT_MAX_PENDING', 256))
+EXTRACT_PROCESSES = os.getenv('EXTRACT_PROCESSES', '0') == '1'
+# How many playlists are expanded at once, on threads of their own.
+EXTRACT_PLAYLIST_WORKERS = int(os.getenv('EXTRACT_PLAYLIST_WORKERS', 2))
+
+# Remembered search results: how many, for how long, and whether they are
+# kept in the cache database across restarts. Plus how many stream URLs to
+# keep until they expire.
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 4096))
+QUERY_CACHE_TTL = int(float(os.getenv('QUERY_CACHE_TTL_HOURS', 24)) * 60 * 60)
+QUERY_CACHE_PERSIST = os.getenv('QUERY_CACHE_PERSIST', '1') == '1'
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', 1024))
+
+# Look searches up in an index of the cached tracks first, playing the best
+# match without searching YouTube if we are at least this confident (0-1) in it.
+LOCAL_SEARCH = os.getenv('LOCAL_SEARCH', '1') == '1'
+LOCAL_SEARCH_CONFIDENCE = float(os.getenv('LOCAL_SEARCH_CONFIDENCE', .75))
+
+# Convert downloads to Opus so they can be sent without decoding, and how
+# many conversions may run at once.
+OPUS_CACHE = os.getenv('OPUS_CACHE', '1') == '1'
+OPUS_BITRATE = os.getenv('OPUS_BITRATE', '128k')
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', 1))
+
+# Measure each cached track's loudness in the background and play it at the
+# target loudness (in LUFS), boosting quiet tracks by at most the given dB.
+LOUDNESS_NORMALIZE = os.getenv('LOUDNESS_NORMALIZE', '1') == '1'
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', -14))
+LOUDNESS_MAX_BOOST = float(os.getenv('LOUDNESS_MAX_BOOST', 10))
+
+# In download mode, start playing a freshly requested track from its stream
+# while it downloads into the cache, instead of waiting for the whole file.
+TEE_DOWNLOADS = os.getenv('TEE_DOWNLOADS', '1') == '1'
+
+# Guilds playing the same track at the same volume read one FFmpeg decode
+# instead of starting one each.
+SHARED_DECODE = os.getenv('SHARED_DECODE', '1') == '1'
+
+# Caps on what the players hold, overall and per guild (0 for no cap). Past
+# the cap on open audio sources, tracks are queued without opening them and
+# the next track isn't opened ahead of time; downloads past theirs wait their
+# turn; full queues take no more tracks; and a guild whose queued downloads
+# pass GUILD_CACHE_MAX_MB (or all of them, CACHE_MAX_MB) streams instead.
+MAX_DECODERS = int(os.getenv('MAX_DECODERS', 256))
+GUILD_MAX_DECODERS = int(os.getenv('GUILD_MAX_DECODERS', 4))
+MAX_DOWNLOADS = int(os.getenv('MAX_DOWNLOADS', 16))
+GUILD_MAX_DOWNLOADS = int(os.getenv('GUILD_MAX_DOWNLOADS', 4))
+MAX_QUEUED = int(os.getenv('MAX_QUEUED', 0))
+GUILD_MAX_QUEUED = int(os.getenv('GUILD_MAX_QUEUED', 1000))
+GUILD_CACHE_MAX_BYTES = int(float(os.getenv('GUILD_CACHE_MAX_MB', 512)) * 1024 * 1024)
+
+# Run the bot as this many processes, splitting the shards between them.
+# SHARD_COUNT=0 asks Discord for the recommended number of shards.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 1))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+
+# Seconds a player may sit with nothing to play before it disconnects
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', 300))
+
+# Skip votes: the share of listeners that must agree, and how many seconds
+# the vote stays open.
+SKIP_VOTE_RATIO = float(os.getenv('SKIP_VOTE_RATIO', .75))
+SKIP_VOTE_TIMEOUT = int(os.getenv('SKIP_VOTE_TIMEOUT', 120))
+
+# Where queues and player state are kept across restarts, and how often
+# (in seconds) playback positions are saved.
+STATE_PATH = os.getenv('STATE_PATH', 'state.db')
+STATE_SAVE_INTERVAL = int(os.getenv('STATE_SAVE_INTERVAL', 15))
+
+# Save the in-memory search and stream URL caches every SNAPSHOT_INTERVAL
+# seconds (0 disables it) and load them back on startup; the workers of a
+# sharded bot each keep their own file.
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'snapshot.json')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 300))
+
+# Serve Prometheus metrics on this port (0 disables it); worker processes of a
+# sharded bot take the following ports. Also print a summary line every
+# METRICS_LOG_INTERVAL seconds, if set.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 0))
+
+# Watch for callbacks that block the event loop for longer than the threshold,
+# logging their stacks and the command and guild they ran for.
+WATCHDOG = os.getenv('WATCHDOG', '0') == '1'
+WATCHDOG_THRESHOLD_MS = int(os.getenv('WATCHDOG_THRESHOLD_MS', 100))
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# When this module was first imported, which music does before anything else
+STARTED = time.perf_counter()
+
+
+class Phases:
+    """
+    How long each step of starting up took, in seconds, in the order they
+    finished. Steps can overlap, e.g. loading youtube_dl in the background
+    while the players reconnect.
+    """
+
+    def __init__(self, started=STARTED):
+        self.started = started
+        self.durations = {}
+        self._last = started
+
+    def mark(self, name):
+        """Record a step that ran from the end of the previous one until now."""
+        now = time.perf_counter()
+        self.durations[name] = now - self._last
+        self._last = now
+
+    @contextmanager
+    def phase(self, name):
+        """Time a ``with`` block as a step of its own."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = time.perf_counter() - started
+            self._last = max(self._last, time.perf_counter())
+
+    def summary(self):
+        steps = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.durations.items())
+        return f'Started in {time.perf_counter() - self.started:.2f}s ({steps})'
+
+
+def snapshot(caches):
+    """
+    What is in some in-memory caches, to save with :func:`save_snapshot`.
+    ``caches`` maps a name to an :class:`ExpiringLRU`; take the snapshot on
+    the thread that uses them.
+    """
+    return {name: cache.snapshot() for name, cache in caches.items()}
+
+
+def save_snapshot(path, state):
+    """Write a :func:`snapshot` to ``path`` (from any thread), replacing the last one."""
+    partial = f'{path}.tmp'
+    with open(partial, 'w') as f:
+        json.dump(state, f)
+    os.replace(partial, path)
+
+
+def load_snapshot(path, caches):
+    """Put back what :func:`save_snapshot` saved, returning how many entries it restored."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        print(f'Could not read the snapshot in {path}: {e}')
+        return 0
+    return sum(cache.restore(state.get(name, [])) for name, cache in caches.items())
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+import urllib.request
+
+CHUNK_SIZE = 64 * 1024
+
+
+class TeeDownload:
+    """
+    Downloads a media URL to a file while it is being played.
+
+    One thread fetches the URL into a ``.part`` file as fast as the server
+    allows. Each reader from :meth:`open_reader` gets a pipe that its own
+    thread fills from that file, waiting whenever it catches up with the
+    download. A slow or paused player therefore never holds the download
+    back, and several players can share one download. Once every byte is in,
+    the file is moved to ``path`` and ``callback(self)`` is called from the
+    download thread; ``error`` is set if the download failed, and ``elapsed``
+    is how long it took in seconds.
+    """
+
+    def __init__(self, url, path, *, headers=None, callback=None):
+        self.url = url
+        self.path = path
+        self.partial = f'{path}.{os.getpid()}.part'
+        self.headers = headers or {}
+        self.callback = callback
+        self.written = 0
+        self.finished = False
+        self.error = None
+        self.elapsed = None
+        self._changed = threading.Condition()
+        self._file = None
+
+    def start(self):
+        # Created up front so readers can open it before the first byte arrives
+        self._file = open(self.partial, 'wb')
+        self._started = time.perf_counter()
+        threading.Thread(target=self._download, name='tee-download', daemon=True).start()
+        return self
+
+    def _download(self):
+        try:
+            request = urllib.request.Request(self.url, headers=self.headers)
+            with self._file as out, urllib.request.urlopen(request, timeout=30) as response:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    out.flush()
+                    with self._changed:
+                        self.written += len(chunk)
+                        self._changed.notify_all()
+            with self._changed:
+                # Together, so readers opened from now on get the finished file
+                os.replace(self.partial, self.path)
+                self.finished = True
+        except Exception as e:
+            self.error = e
+            try:
+                os.remove(self.partial)
+            except OSError:
+                pass
+        finally:
+            self.elapsed = time.perf_counter() - self._started
+            with self._changed:
+                self.finished = True
+                self._changed.notify_all()
+        if self.callback is not None:
+            self.callback(self)
+
+    def open_reader(self):
+        """A file object that yields the download's bytes as they arrive."""
+        with self._changed:
+            source = open(self.path if self.finished else self.partial, 'rb')
+        read_fd, write_fd = os.pipe()
+        threading.Thread(target=self._feed, args=(source, os.fdopen(write_fd, 'wb')),
+                         name='tee-feed', daemon=True).start()
+        return os.fdopen(read_fd, 'rb')
+
+    def _feed(self, source, pipe):
+        try:
+            with source, pipe:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if chunk:
+                        pipe.write(chunk)
+                        continue
+                    with self._changed:
+                        self._changed.wait_for(
+                            lambda: self.finished or self.written > source.tell())
+                        if self.finished and self.written <= source.tell():
+                            break
+        except OSError:
+            # The reader went away (e.g. the track was skipped)
+            pass
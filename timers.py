@@ -0,0 +1,68 @@
+import asyncio
+import math
+import time
+
+
+class TimerWheel:
+    """
+    Many coarse timers driven by a single task.
+
+    Timers are hashed into a ring of slots by the tick they are due on, and
+    the task only looks at one slot per tick, so scheduling, cancelling and
+    firing a timer are all O(1) no matter how many guilds have one pending.
+    Each timer has a key; scheduling a key again replaces its timer.
+    """
+
+    def __init__(self, loop, *, resolution=1.0, slots=512):
+        self.loop = loop
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._timers = {}  # key -> (due tick, callback)
+        self._tick = 0
+        self._task = None
+
+    def schedule(self, key, delay, callback):
+        """Call ``callback()`` in about ``delay`` seconds."""
+        self.cancel(key)
+        due = self._tick + max(1, math.ceil(delay / self.resolution))
+        self._timers[key] = (due, callback)
+        self._slots[due % len(self._slots)].add(key)
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def cancel(self, key):
+        try:
+            due, _ = self._timers.pop(key)
+        except KeyError:
+            return
+        self._slots[due % len(self._slots)].discard(key)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+    async def _run(self):
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(self.resolution)
+            # Catch up on every tick we should have seen, even if the loop lagged
+            now = int((time.monotonic() - start) / self.resolution)
+            while self._tick < now:
+                self._tick += 1
+                self._fire(self._tick)
+
+    def _fire(self, tick):
+        slot = self._slots[tick % len(self._slots)]
+        for key in list(slot):
+            due, callback = self._timers[key]
+            if due > tick:
+                # Due on a later trip around the ring
+                continue
+            slot.discard(key)
+            del self._timers[key]
+            try:
+                callback()
+            except Exception as e:
+                print(f'Timer {key!r} failed: {e}')
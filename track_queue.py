@@ -0,0 +1,202 @@
+import asyncio
+import random
+from collections import deque
+
+
+class _Node:
+    __slots__ = ('item', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, item):
+        self.item = item
+        self.priority = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node, k):
+    """Split a treap into its first ``k`` items and the rest."""
+    if node is None:
+        return None, None
+    if _size(node.left) >= k:
+        left, node.left = _split(node.left, k)
+        _update(node)
+        return left, node
+    node.right, right = _split(node.right, k - _size(node.left) - 1)
+    _update(node)
+    return node, right
+
+
+def _merge(left, right):
+    """Join two treaps, every item of ``left`` coming first."""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+class TrackQueue:
+    """
+    A queue of tracks that can also be edited by position.
+
+    It is an implicit treap (a randomly balanced tree ordered by position),
+    so indexing, inserting, removing and moving an item are all O(log n),
+    and listing a page of k items is O(log n + k) rather than walking the
+    whole queue. Shuffling and de-duplicating are O(n).
+
+    :meth:`get` and :meth:`put_nowait` behave like :class:`asyncio.Queue`'s.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._getters = deque()
+
+    def __len__(self):
+        return _size(self._root)
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return self._root is None
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('queue index out of range')
+        return index
+
+    def __getitem__(self, index):
+        index = self._index(index)
+        node = self._root
+        while True:
+            left = _size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.item
+            else:
+                index -= left + 1
+                node = node.right
+
+    def __iter__(self):
+        return self.slice(0, len(self))
+
+    def slice(self, start, stop):
+        """Iterate over the items from ``start`` up to ``stop``."""
+        stop = min(stop, len(self))
+        count = stop - start
+        if count <= 0:
+            return
+
+        # Walk down to the item at ``start``, stacking the nodes still to visit
+        stack = []
+        node, index = self._root, start
+        while node is not None:
+            left = _size(node.left)
+            if index < left:
+                stack.append(node)
+                node = node.left
+            elif index == left:
+                stack.append(node)
+                break
+            else:
+                index -= left + 1
+                node = node.right
+
+        while stack and count:
+            node = stack.pop()
+            yield node.item
+            count -= 1
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def insert(self, index, item):
+        """Insert an item before ``index`` (``len(queue)`` appends it)."""
+        index = max(0, min(index, len(self)))
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, _Node(item)), right)
+        self._wakeup_next()
+
+    def put_nowait(self, item):
+        self.insert(len(self), item)
+
+    def pop(self, index=0):
+        """Remove and return the item at ``index``."""
+        index = self._index(index)
+        left, right = _split(self._root, index)
+        node, right = _split(right, 1)
+        self._root = _merge(left, right)
+        return node.item
+
+    def move(self, source, destination):
+        """Move the item at ``source`` so it ends up at ``destination``."""
+        item = self.pop(source)
+        self.insert(destination, item)
+        return item
+
+    def _rebuild(self, items):
+        self._root = None
+        for item in items:
+            self._root = _merge(self._root, _Node(item))
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self._rebuild(items)
+
+    def dedupe(self, key):
+        """Drop every item whose ``key(item)`` was already seen earlier; returns them."""
+        seen = set()
+        kept, dropped = [], []
+        for item in self:
+            k = key(item)
+            if k in seen:
+                dropped.append(item)
+            else:
+                seen.add(k)
+                kept.append(item)
+        if dropped:
+            self._rebuild(kept)
+        return dropped
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def get(self):
+        """Remove and return the first item, waiting for one if necessary."""
+        while self.empty():
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if not self.empty() and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.pop(0)
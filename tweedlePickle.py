@@ -3,21 +3,41 @@ import discord
 import os
 from discord.ext import commands
 from dotenv import load_dotenv
-from music import Music
+
+import settings
 
 load_dotenv()
 token = os.getenv('DISCORD_TOKEN')
 
-bot = commands.Bot(command_prefix=commands.when_mentioned_or("~"),
+
+def make_bot(shard_ids=None, shard_count=None):
+    from music import Music
+    
+    options = dict(command_prefix=commands.when_mentioned_or("~"),
                    description='Tweddle my pickle.')
+    if shard_count is None:
+        bot = commands.Bot(**options)
+    else:
+        bot = commands.AutoShardedBot(shard_ids=shard_ids, shard_count=shard_count, **options)
+    
+    @bot.event
+    async def on_ready():
+        print('Logged in as {0} ({0.id})'.format(bot.user))
+        print('------')
+    
+    bot.add_cog(Music(bot))
+    return bot
 
-music = Music(bot)
 
-@bot.event
-async def on_ready():
-    print('Logged in as {0} ({0.id})'.format(bot.user))
-    print('------')
+def run(shard_ids=None, shard_count=None):
+    make_bot(shard_ids, shard_count).run(token)
 
 
-bot.add_cog(music)
-bot.run(token)
+if __name__ == '__main__':
+    if settings.SHARD_WORKERS > 1:
+        from launcher import Supervisor, recommended_shards
+        
+        shard_count = settings.SHARD_COUNT or recommended_shards(token) or settings.SHARD_WORKERS
+        Supervisor(settings.SHARD_WORKERS, shard_count).run()
+    else:
+        run()
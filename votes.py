@@ -0,0 +1,94 @@
+import math
+
+YES = "✅"
+NO = "❎"
+
+
+class Vote:
+    """
+    A vote to skip a guild's current track, tallied from reactions.
+
+    ``voters`` is how many listeners may vote; the vote passes as soon as
+    ``needed`` of them vote yes and fails as soon as enough vote no that it
+    can't pass any more.
+    """
+
+    __slots__ = ('book', 'guild_id', 'message', 'track', 'voters', 'needed', 'yes', 'no',
+                 'on_done', 'done')
+
+    def __init__(self, book, guild_id, message, track, *, voters, needed, on_done):
+        self.book = book
+        self.guild_id = guild_id
+        self.message = message
+        self.track = track
+        self.voters = voters
+        self.needed = needed
+        self.yes = set()
+        self.no = set()
+        self.on_done = on_done
+        self.done = False
+
+    def react(self, user_id, emoji, added):
+        """Count (or uncount) someone's reaction to the vote message."""
+        if emoji == YES:
+            tally = self.yes
+        elif emoji == NO:
+            tally = self.no
+        else:
+            return
+        if added:
+            tally.add(user_id)
+        else:
+            tally.discard(user_id)
+
+        if len(self.yes) >= self.needed:
+            self.book.finish(self, True)
+        elif len(self.no) > self.voters - self.needed:
+            self.book.finish(self, False)
+
+
+class VoteBook:
+    """
+    Every open skip vote, by guild and by message.
+
+    Votes are driven by reaction events and their deadlines are timers on
+    the cog's timer wheel, so an open vote is just a few entries in dicts:
+    there is no coroutine waiting on it. ``on_done(vote, passed)`` is called
+    once, with ``passed`` None if the vote was called off.
+    """
+
+    def __init__(self, timers):
+        self.timers = timers
+        self.by_guild = {}
+        self.by_message = {}
+
+    def get(self, message_id):
+        return self.by_message.get(message_id)
+
+    def open(self, guild_id):
+        """The guild's open vote, if it has one."""
+        return self.by_guild.get(guild_id)
+
+    def start(self, guild_id, message, track, *, voters, ratio, timeout, on_done):
+        needed = max(1, math.ceil(voters * ratio))
+        vote = Vote(self, guild_id, message, track, voters=voters, needed=needed,
+                    on_done=on_done)
+        self.by_guild[guild_id] = vote
+        self.by_message[message.id] = vote
+        self.timers.schedule(('vote', guild_id), timeout, lambda: self.finish(vote, False))
+        return vote
+
+    def finish(self, vote, passed):
+        if vote.done:
+            return
+        vote.done = True
+        self.by_guild.pop(vote.guild_id, None)
+        self.by_message.pop(vote.message.id, None)
+        self.timers.cancel(('vote', vote.guild_id))
+        vote.on_done(vote, passed)
+
+    def cancel(self, guild_id):
+        """Call off a guild's vote, e.g. because the track changed."""
+        vote = self.by_guild.get(guild_id)
+        if vote is not None:
+            self.finish(vote, None)
@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+import traceback
+from asyncio import events
+
+# (command name, guild id) of whatever is running; the cog sets it for each
+# command, and tasks started from there inherit it.
+current = contextvars.ContextVar('current', default=None)
+
+# Offenders kept, by command, guild and place; the ones that cost least go first
+MAX_OFFENDERS = 500
+HERE = os.path.dirname(os.path.abspath(__file__))
+THIS = os.path.abspath(__file__)
+
+
+def _callback_stack(frame):
+    """The stack of a frame, from the callback the loop is running down."""
+    stack = traceback.extract_stack(frame)
+    for index in range(len(stack) - 1, -1, -1):
+        if stack[index].filename == THIS:
+            # Drop the loop, our wrapper and asyncio's Handle._run
+            return stack[index + 2:] or stack
+    return stack
+
+
+def _where(stack):
+    """The innermost frame in our own code, else the innermost one."""
+    for frame in reversed(stack):
+        if frame.filename.startswith(HERE) and frame.filename != THIS:
+            break
+    else:
+        frame = stack[-1]
+    return f'{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}'
+
+
+class Watchdog:
+    """
+    Measures event loop lag and catches callbacks that block the loop.
+
+    Every callback the loop runs is timed. A thread watches the one that is
+    running and, once it has run for ``threshold`` seconds, samples the loop
+    thread's stack so we can see what it is stuck on. When the callback
+    finishes it is logged and recorded against the command and guild it ran
+    for (from :data:`current`) and the place it blocked.
+
+    Lag is measured separately by sleeping for ``interval`` and seeing how
+    late the loop wakes up. ``lag`` and ``blocked`` are histograms to record
+    into, if given.
+    """
+
+    def __init__(self, loop, *, threshold=0.1, interval=0.5, lag=None, blocked=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = lag
+        self.blocked = blocked
+        self.last_lag = 0.0
+        # (command, guild, where) -> [count, total seconds, worst seconds, worst stack]
+        self.offenders = {}
+        self._thread_id = None
+        self._running = None  # when the callback running now started
+        self._sample = None  # (when its callback started, stack)
+        self._stopped = threading.Event()
+        self._original = None
+        self._task = None
+
+    def start(self):
+        """Start watching; call this from the loop's thread."""
+        self._thread_id = threading.get_ident()
+        original = self._original = events.Handle._run
+        watchdog = self
+
+        def _run(handle):
+            if threading.get_ident() != watchdog._thread_id:
+                return original(handle)
+            started = watchdog._running = time.perf_counter()
+            try:
+                return original(handle)
+            finally:
+                watchdog._running = None
+                elapsed = time.perf_counter() - started
+                if elapsed >= watchdog.threshold:
+                    watchdog.record(handle, started, elapsed)
+
+        events.Handle._run = _run
+        threading.Thread(target=self._monitor, name='watchdog', daemon=True).start()
+        self._task = self.loop.create_task(self._measure_lag())
+
+    def stop(self):
+        if self._original is not None:
+            events.Handle._run = self._original
+            self._original = None
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def _monitor(self):
+        while not self._stopped.wait(self.threshold / 4):
+            started = self._running
+            if started is None or time.perf_counter() - started < self.threshold:
+                continue
+            if self._sample is not None and self._sample[0] == started:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self._sample = (started, _callback_stack(frame))
+
+    async def _measure_lag(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, time.perf_counter() - before - self.interval)
+            if self.lag is not None:
+                self.lag.observe(self.last_lag)
+
+    def record(self, handle, started, elapsed):
+        context = getattr(handle, '_context', None)
+        command, guild = (context and context.get(current)) or (None, None)
+        stack = None
+        if self._sample is not None and self._sample[0] == started:
+            stack = self._sample[1]
+            self._sample = None
+        if stack:
+            where = _where(stack)
+        else:
+            # Finished before the monitor looked, so all we have is the callback
+            callback = getattr(handle, '_callback', None)
+            where = getattr(callback, '__qualname__', repr(callback))
+
+        key = (command, guild, where)
+        offender = self.offenders.get(key)
+        if offender is None:
+            if len(self.offenders) >= MAX_OFFENDERS:
+                del self.offenders[min(self.offenders, key=lambda k: self.offenders[k][1])]
+            offender = self.offenders[key] = [0, 0.0, 0.0, None]
+        offender[0] += 1
+        offender[1] += elapsed
+        if elapsed >= offender[2]:
+            offender[2] = elapsed
+            offender[3] = stack or offender[3]
+        if self.blocked is not None:
+            self.blocked.observe(elapsed, command=command or 'none')
+
+        print(f'Blocked the event loop for {elapsed * 1000:.0f}ms in {command or "?"} '
+              f'(guild {guild}) at {where}')
+        if stack:
+            print(''.join(traceback.format_list(stack[-8:])), end='')
+
+    def worst(self, count=10):
+        """The offenders that blocked the loop longest in total, as dicts."""
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)
+        return [{'command': command, 'guild': guild, 'where': where, 'count': n,
+                 'total': total, 'worst': worst, 'stack': stack}
+                for (command, guild, where), (n, total, worst, stack) in ranked[:count]]